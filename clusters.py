@@ -20,8 +20,14 @@ min_fire = 0.5
 quality = 'good'
 path_root = Path("/Users/vojtamazur/Documents/Capstone_code")
 experiment = ["ChangeDetectionConflict"]
-
-trialData, sessionData, spikeData = utils.load_data(path_root, experiment)
+cache_dir = "./dataCache"
+
+trialData, sessionData, spikeData = utils.load_data(
+    path_root,
+    experiment,
+    cache_dir=cache_dir,
+    data_types=['trialData', 'sessionData', 'spikeData']
+)
 spikeData = utils.exclude_neurons(spikeData, sessionData, min_fire, quality)
 
 
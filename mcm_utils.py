@@ -0,0 +1,705 @@
+import numpy as np
+import pandas as pd
+import raster_plots as rplt
+import utils
+from scipy.special import gammaln
+import scipy.cluster.hierarchy as sch
+from sklearn.preprocessing import MinMaxScaler
+import os
+import math
+import hashlib
+import pickle
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+
+
+# A function that takes a set of trial data and turns it into a single
+# (data points x neurons) array of the bins between startBin and stopBin
+def trials_to_array(trialData, startBin, stopBin):
+    # Check if the input trial data is a dataframe
+    # (i.e. contains more than one trial)
+    if isinstance(trialData, pd.DataFrame):
+        # Concatenate the bins of all of the trials
+        return np.concatenate(trial_arrays(trialData, startBin, stopBin))
+
+    # Otherwise, handle the trialData as a series
+    neuron_arr = np.array(list(trialData["binSpikes"].values()))
+    return np.transpose(neuron_arr[:, startBin:stopBin])
+
+
+# The (bins x neurons) data array of every trial, with the bins between startBin and stopBin.
+# trialData is either a dataframe of binarized trials (as for trials_to_array)
+# or a list of the (bins x neurons) arrays of the trials.
+def trial_arrays(trialData, startBin, stopBin):
+    if isinstance(trialData, pd.DataFrame):
+        trial_spikes, _ = rplt.trim_spikes(trialData)
+        return [np.array(list(trial.values()))[:, startBin:stopBin].T for trial in trial_spikes]
+
+    return [np.asarray(trial_arr)[startBin:stopBin] for trial_arr in trialData]
+
+
+# Write a 0/1 data array into a .dat file in the structure necessary for the MCM module
+# (one line of '0'/'1' characters per data point). The whole array is turned into
+# ASCII characters at once and written with a single call.
+def write_input_file(data_arr, filename, path):
+    # Check if the save directory exists, and if not, create it
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    with open(os.path.join(path, f"{filename}.dat"), "wb") as file:
+        file.write(array_to_bytes(data_arr))
+
+
+# Turn a 0/1 data array into the text of an MCM input file
+def array_to_bytes(data_arr):
+    data_arr = np.atleast_2d(np.asarray(data_arr))
+
+    # Add the character code of '0' to every value and a newline at the end of every row
+    chars = np.empty((data_arr.shape[0], data_arr.shape[1] + 1), dtype=np.uint8)
+    chars[:, :-1] = data_arr
+    chars[:, :-1] += ord('0')
+    chars[:, -1] = ord('\n')
+
+    return chars.tobytes()
+
+
+# Directory for the data files that are only handed to MinCompSpin: a RAM-backed
+# file system if there is one, so that no data has to go through the disk
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+
+
+# Write a 0/1 data array into a uniquely named MCM input file and yield its path.
+# The file is removed at the end of the with block, so concurrent tasks never
+# share or overwrite each other's input files.
+@contextmanager
+def scratch_input_file(data_arr):
+    fd, file_path = tempfile.mkstemp(suffix=".dat", dir=SCRATCH_DIR)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(array_to_bytes(data_arr))
+        yield file_path
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+# Build the data object that MinCompSpin expects directly from a 0/1 data array
+# of shape (data points x n). The module can only read its data from a file, so the
+# data goes through a scratch file that is removed right after it is read.
+def data_from_array(data_arr, n):
+    # MinCompSpin is only imported when it is needed, so that the functions that
+    # score partitions with NumPy can also be used without the compiled module
+    import MinCompSpin_Python.MinCompSpin as mod
+
+    with scratch_input_file(data_arr) as file_path:
+        return mod.read_datafile(file_path, n)
+
+
+# Turn the components of an MCM partition (as in MCM_best.array) into a
+# (components x n) boolean array, with the neurons of every component set to True
+def partition_to_masks(MCM_partition, n):
+    masks = np.zeros((len(MCM_partition), n), dtype=bool)
+
+    for c, array in enumerate(MCM_partition):
+        if n <= 64:
+            component = bin(array[1])[2:].zfill(n)
+        else:
+            component = bin(array[1])[2:].zfill(64) + bin(array[2])[2:].zfill(n-64)
+
+        masks[c] = np.frombuffer(component.encode(), dtype=np.uint8) == ord('1')
+
+    return masks
+
+
+# The co-occurrence matrix of an MCM partition: 1 for every pair of different
+# neurons in the same component (the same as models.generate_coocurrance_matrix)
+def coocurrance_matrix(MCM_partition, n):
+    masks = partition_to_masks(MCM_partition, n).astype(np.int64)
+    matrix = (masks.T @ masks > 0).astype(float)
+    np.fill_diagonal(matrix, 0)
+
+    return matrix
+
+
+# The index of the component of every neuron in an MCM partition
+def partition_to_clusters(MCM_partition, n):
+    return partition_to_masks(MCM_partition, n).argmax(axis=0)
+
+
+# The linkage matrix of the hierarchical clustering of neurons based on a co-occurrence
+# matrix (as models.get_linkage_matrix; the column-wise scaling can make the distance
+# matrix slightly asymmetric, so only its upper triangle is used)
+def linkage_from_cooccurrence(co_occurrence_matrix):
+    # Convert to distance matrix
+    distance_matrix = np.max(co_occurrence_matrix) - co_occurrence_matrix
+    np.fill_diagonal(distance_matrix, 0)
+
+    # Scaling the distance matrix so that its values are between 1 and 0
+    distance_matrix_norm = MinMaxScaler().fit_transform(distance_matrix)
+
+    return sch.linkage(sch.distance.squareform(distance_matrix_norm, checks=False), method='ward')
+
+
+# Maximum number of fits kept in an MCM fit cache directory
+MCM_CACHE_MAX_ENTRIES = 10000
+
+
+# The cache key of an MCM fit: a hash of the binary data matrix, n and the search options
+def mcm_cache_key(data_arr, n, options):
+    data_arr = np.ascontiguousarray(data_arr, dtype=np.uint8)
+
+    key_hash = hashlib.sha1(data_arr.tobytes())
+    key_hash.update(repr((data_arr.shape, n, options)).encode())
+
+    return key_hash.hexdigest()
+
+
+# Remove the least recently used fits from the cache directory until at most max_entries are left
+def evict_mcm_cache(cache_dir, max_entries=MCM_CACHE_MAX_ENTRIES):
+    entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith(".pkl")]
+    if len(entries) <= max_entries:
+        return
+
+    def last_used(entry):
+        try:
+            return entry.stat().st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    entries.sort(key=last_used)
+    for entry in entries[:len(entries) - max_entries]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            # Already removed by another worker
+            pass
+
+
+# Fit an MCM to one data array and return its partition, log evidence and log likelihood.
+# If a cache directory is given, the fits are stored there by the content of the data,
+# so that a data array that was fitted before is not fitted again. Reading a fit marks it
+# as recently used and the least recently used fits are evicted beyond max_entries.
+def fit_mcm(data_arr, n, cache_dir=None, max_entries=MCM_CACHE_MAX_ENTRIES):
+    # Options of MCM_GreedySearch that are part of the cache key
+    search_options = (False,)
+
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f"{mcm_cache_key(data_arr, n, search_options)}.pkl")
+        try:
+            with open(cache_file, "rb") as file:
+                fit = pickle.load(file)
+            os.utime(cache_file)
+            return fit["array"], fit["logE"], fit["logL"]
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            pass
+
+    import MinCompSpin_Python.MinCompSpin as mod
+    data = data_from_array(data_arr, n)
+
+    MCM_best = mod.MCM_GreedySearch(data, n, *search_options)
+    logE = mod.LogE_MCM(data, MCM_best, MCM_best.r)
+    logL = mod.LogL_MCM(data, MCM_best, MCM_best.r)
+
+    # Store the components as tuples so that they can be sent between processes
+    partition = [tuple(array) for array in MCM_best.array]
+
+    if cache_dir is not None:
+        # Write to a temporary file first so that parallel workers never read a half-written fit
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as file:
+            fit = {"array": partition, "r": MCM_best.r, "logE": logE, "logL": logL}
+            pickle.dump(fit, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+        evict_mcm_cache(cache_dir, max_entries)
+
+    return partition, logE, logL
+
+
+# Draw sample_count samples of sample_size trials (without replacement within a sample)
+# from the given trials, with a random generator seeded with seed
+def draw_trial_samples(n_trials, sample_size, sample_count, seed=None):
+    rng = np.random.default_rng(seed)
+
+    return [rng.choice(n_trials, size=sample_size, replace=False) for _ in range(sample_count)]
+
+
+# Bootstrap MCMs of concatenated trials: fit an MCM to each of sample_count samples of
+# sample_size trials, with the fits run in a pool of n_workers processes (all CPUs if None).
+# The samples are all drawn up front from the seed and the results are kept in sample order,
+# so the results only depend on the seed and not on the number of workers.
+# Returns the partitions, log evidences and log likelihoods of the fits and the
+# co-occurrence matrix summed over all of the fits. The fits are cached in cache_dir if given.
+def bootstrap_mcm(trialData, sample_size, sample_count, n, startBin, stopBin, seed=None, n_workers=None, cache_dir=None):
+    # Get the (bins x neurons) data of every trial once
+    trial_arrs = trial_arrays(trialData, startBin, stopBin)
+
+    samples = draw_trial_samples(len(trial_arrs), sample_size, sample_count, seed)
+    sample_arrs = [np.concatenate([trial_arrs[t] for t in sample]) for sample in samples]
+
+    if n_workers == 1:
+        results = [fit_mcm(data_arr, n, cache_dir) for data_arr in sample_arrs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(fit_mcm, sample_arrs, [n] * len(sample_arrs), [cache_dir] * len(sample_arrs)))
+
+    partitions = [partition for partition, _, _ in results]
+    logE_list = [logE for _, logE, _ in results]
+    logL_list = [logL for _, _, logL in results]
+
+    superimposed_matrix = np.zeros((n, n))
+    for partition in partitions:
+        superimposed_matrix += coocurrance_matrix(partition, n)
+
+    return partitions, logE_list, logL_list, superimposed_matrix
+
+
+# The convergence statistic of a bootstrap: the mean absolute change of the normalized
+# co-occurrence matrix (the fraction of fits in which each pair of neurons shares a component)
+# when the co-occurrence matrix of a new fit is added to the sum over the first k fits
+def cooccurrence_change(superimposed_matrix, co_matrix, k):
+    return np.abs((superimposed_matrix + co_matrix)/(k+1) - superimposed_matrix/k).mean()
+
+
+# Adaptive version of bootstrap_mcm: fits are added until the convergence statistic
+# (cooccurrence_change) of the last fit is below tol, with at least min_samples and at most
+# max_samples fits (always max_samples if tol is None). The fits are run in batches of n_workers
+# processes (all CPUs if None); the statistic is checked fit by fit in sample order and the fits
+# of a batch after the stopping point are discarded, so the number of fits and the results only
+# depend on the seed. If store_path is given, every fit is recorded in a results store there
+# (see utils.run_sweep) under its sample number, and fits already in the store are not rerun,
+# so an interrupted bootstrap resumes where it stopped (with the same data and seed).
+# Returns the same as bootstrap_mcm, together with the statistic after every added fit.
+def adaptive_bootstrap_mcm(trialData, sample_size, n, startBin, stopBin, tol=0.01, min_samples=10, max_samples=30,
+                           seed=None, n_workers=None, cache_dir=None, store_path=None):
+    # Get the (bins x neurons) data of every trial once
+    trial_arrs = trial_arrays(trialData, startBin, stopBin)
+
+    # The same samples as bootstrap_mcm draws for max_samples fits
+    samples = draw_trial_samples(len(trial_arrs), sample_size, max_samples, seed)
+    batch_size = 1 if n_workers == 1 else (n_workers or os.cpu_count())
+    executor = None if n_workers == 1 else ProcessPoolExecutor(max_workers=n_workers)
+
+    # Fit the samples with the given numbers, yielding the results in sample order
+    def fit_samples(sample_numbers):
+        sample_arrs = [np.concatenate([trial_arrs[t] for t in samples[i]]) for i in sample_numbers]
+        if executor is None:
+            return (fit_mcm(data_arr, n, cache_dir) for data_arr in sample_arrs)
+        return executor.map(fit_mcm, sample_arrs, [n] * len(sample_arrs), [cache_dir] * len(sample_arrs))
+
+    results = []
+    changes = []
+    superimposed_matrix = np.zeros((n, n))
+    converged = False
+
+    try:
+        while not converged and len(results) < max_samples:
+            batch = list(range(len(results), min(len(results) + batch_size, max_samples)))
+
+            if store_path is None:
+                batch_results = fit_samples(batch)
+            else:
+                batch_results = utils.run_sweep(batch, fit_samples, store_path, batch=True).values()
+
+            for result in batch_results:
+                co_matrix = coocurrance_matrix(result[0], n)
+                if results:
+                    changes.append(cooccurrence_change(superimposed_matrix, co_matrix, len(results)))
+                superimposed_matrix += co_matrix
+                results.append(result)
+
+                if tol is not None and len(results) >= min_samples and changes and changes[-1] < tol:
+                    converged = True
+                    break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    partitions = [partition for partition, _, _ in results]
+    logE_list = [logE for _, logE, _ in results]
+    logL_list = [logL for _, _, logL in results]
+
+    return partitions, logE_list, logL_list, superimposed_matrix, changes
+
+
+# Pack the rows of a 0/1 data array into the state words used by MCM_best.array:
+# the first 64 variables in the first word and the rest in the second word,
+# with the first variable of each word as its most significant bit
+def pack_states(data_arr, n):
+    data_arr = np.asarray(data_arr, dtype=np.uint64).reshape(-1, n)
+    packed = np.zeros((len(data_arr), 2), dtype=np.uint64)
+
+    for w, (first, last) in enumerate([(0, min(n, 64)), (64, n)]):
+        if last <= first:
+            continue
+        shifts = np.arange(last - first - 1, -1, -1, dtype=np.uint64)
+        packed[:, w] = np.bitwise_or.reduce(data_arr[:, first:last] << shifts, axis=1)
+
+    return packed
+
+
+# The state words of the components of an MCM partition as a (components x 2) array
+def partition_to_words(MCM_partition, n):
+    words = np.zeros((len(MCM_partition), 2), dtype=np.uint64)
+
+    for c, array in enumerate(MCM_partition):
+        words[c, 0] = array[1]
+        if n > 64:
+            words[c, 1] = array[2]
+
+    return words
+
+
+# The different rows of a packed state array and the number of times each of them occurs
+def count_states(packed):
+    states, counts = np.unique(packed, axis=0, return_counts=True)
+    return [tuple(state) for state in states.tolist()], counts.tolist()
+
+
+# Collapse a 0/1 data array into its pattern histogram: the different states that occur in it
+# (packed as in pack_states, so also for n > 64) and the number of times each state occurs
+def pattern_histogram(data_arr, n):
+    return np.unique(pack_states(data_arr, n), axis=0, return_counts=True)
+
+
+# The log evidence and log likelihood of every component (given by its state words, as a
+# (components x 2) array) for the data in a pattern histogram, each component as a complete
+# model with the Jeffreys prior. The marginal state counts of all components are found in one
+# np.unique call over (component, masked state) keys and summed per component with np.bincount.
+def score_components(states, counts, words):
+    n_components, n_states = len(words), len(states)
+    N = counts.sum()
+
+    masked_states = (states[None, :, :] & words[:, None, :]).reshape(-1, 2)
+    component_idx = np.repeat(np.arange(n_components, dtype=np.uint64), n_states)
+    keys, inverse = np.unique(np.column_stack((component_idx, masked_states)), axis=0, return_inverse=True)
+    marginal_counts = np.bincount(inverse.ravel(), weights=np.tile(counts, n_components), minlength=len(keys))
+
+    key_components = keys[:, 0].astype(np.int64)
+    evidence_sums = np.bincount(key_components, weights=state_evidence(marginal_counts), minlength=n_components)
+    likelihood_sums = np.bincount(key_components, weights=state_likelihood(marginal_counts), minlength=n_components)
+
+    m = component_sizes(words)
+    logE = gammaln(2.0**(m-1)) - gammaln(N + 2.0**(m-1)) + evidence_sums
+    logL = likelihood_sums - N * np.log(N)
+
+    return logE, logL
+
+
+# Turn data given either as a 0/1 data array or as a pattern histogram into a pattern histogram
+def as_histogram(data, n):
+    if isinstance(data, tuple):
+        states, counts = data
+        return np.asarray(states, dtype=np.uint64).reshape(-1, 2), np.asarray(counts)
+
+    return pattern_histogram(data, n)
+
+
+# The log evidence and log likelihood of an MCM partition (given as MCM_best.array) for a 0/1
+# data array or a pattern histogram, with the variables that are in no component as
+# independent fair coins. Gives the same values as mod.LogE_MCM and mod.LogL_MCM without
+# needing an MCM object.
+def evaluate_partition(data, MCM_partition, n):
+    logE_list, logL_list = evaluate_partitions(data, [MCM_partition], n)
+    return logE_list[0], logL_list[0]
+
+
+# Score many partitions against the same data. The data is collapsed into a pattern histogram
+# once and each different component of all of the partitions is only scored once.
+def evaluate_partitions(data, MCM_partitions, n):
+    states, counts = as_histogram(data, n)
+    N = counts.sum()
+
+    # Find the different components of all of the partitions
+    partition_words = [partition_to_words(MCM_partition, n) for MCM_partition in MCM_partitions]
+    component_ids = {}
+    for words in partition_words:
+        for component_words in words.tolist():
+            component_ids.setdefault(tuple(component_words), len(component_ids))
+
+    unique_words = np.array(list(component_ids), dtype=np.uint64).reshape(-1, 2)
+    component_logE, component_logL = score_components(states, counts, unique_words)
+
+    logE_list = []
+    logL_list = []
+    for words in partition_words:
+        idx = [component_ids[tuple(component_words)] for component_words in words.tolist()]
+        independent = -(n - component_sizes(words).sum()) * N * np.log(2)
+        logE_list.append(independent + component_logE[idx].sum())
+        logL_list.append(independent + component_logL[idx].sum())
+
+    return logE_list, logL_list
+
+
+# The log evidence of an MCM partition for the data in a pattern histogram
+def histogram_log_evidence(states, counts, MCM_partition, n):
+    return evaluate_partition((states, counts), MCM_partition, n)[0]
+
+
+# The log likelihood of an MCM partition for the data in a pattern histogram
+def histogram_log_likelihood(states, counts, MCM_partition, n):
+    return evaluate_partition((states, counts), MCM_partition, n)[1]
+
+
+# The number of variables in each component, given the state words of the components
+def component_sizes(words):
+    bits = np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=1)
+    return bits.sum(axis=1, dtype=np.int64)
+
+
+# A table of the number of times every state occurs in a window of data points, that is
+# updated as data points enter and leave the window. If a partition is given, the counts of
+# the states of each of its components are kept too, together with the sums that the log
+# evidence and log likelihood of the partition are made of, so that both can be read off at
+# any time at a cost that only depends on the number of changed data points.
+class StateCounts:
+    def __init__(self, n, MCM_partition=None):
+        self.n = n
+        self.N = 0
+        self.states = Counter()
+
+        self.words = partition_to_words([] if MCM_partition is None else MCM_partition, n)
+        self.sizes = component_sizes(self.words).tolist()
+        self.component_states = [Counter() for _ in self.sizes]
+
+        # Sum of lgamma(k + 1/2) - lgamma(1/2) and of k log(k) over the states of each component
+        self.evidence_sums = np.zeros(len(self.sizes))
+        self.likelihood_sums = np.zeros(len(self.sizes))
+
+    def add(self, packed):
+        self.update(packed, 1)
+
+    def remove(self, packed):
+        self.update(packed, -1)
+
+    def update(self, packed, sign):
+        packed = np.asarray(packed, dtype=np.uint64).reshape(-1, 2)
+        self.N += sign * len(packed)
+
+        update_counter(self.states, *count_states(packed), sign)
+
+        for c, words in enumerate(self.words):
+            states, counts = count_states(packed & words)
+            old_counts = update_counter(self.component_states[c], states, counts, sign)
+            new_counts = np.array(old_counts) + sign * np.array(counts)
+            old_counts = np.array(old_counts)
+
+            self.evidence_sums[c] += (state_evidence(new_counts) - state_evidence(old_counts)).sum()
+            self.likelihood_sums[c] += (state_likelihood(new_counts) - state_likelihood(old_counts)).sum()
+
+    # The log evidence of the partition for the data points in the window,
+    # with the variables that are in no component as independent fair coins
+    def log_evidence(self):
+        logE = -(self.n - sum(self.sizes)) * self.N * np.log(2)
+        for m, evidence_sum in zip(self.sizes, self.evidence_sums):
+            logE += math.lgamma(2**(m-1)) - math.lgamma(self.N + 2**(m-1)) + evidence_sum
+
+        return logE
+
+    # The log likelihood of the partition for the data points in the window
+    def log_likelihood(self):
+        logL = -(self.n - sum(self.sizes)) * self.N * np.log(2)
+        for likelihood_sum in self.likelihood_sums:
+            logL += likelihood_sum - (self.N * np.log(self.N) if self.N > 0 else 0)
+
+        return logL
+
+
+# Add (sign = 1) or remove (sign = -1) counts of states from a counter,
+# returning the counts of the states before the update
+def update_counter(counter, states, counts, sign):
+    old_counts = []
+    for state, count in zip(states, counts):
+        old_count = counter[state]
+        old_counts.append(old_count)
+        if old_count + sign * count > 0:
+            counter[state] = old_count + sign * count
+        else:
+            del counter[state]
+
+    return old_counts
+
+
+# lgamma(k + 1/2) - lgamma(1/2) for every state count k
+def state_evidence(counts):
+    return gammaln(np.asarray(counts, dtype=float) + 0.5) - gammaln(0.5)
+
+
+# k log(k) for every state count k (0 for k = 0)
+def state_likelihood(counts):
+    counts = np.asarray(counts, dtype=float)
+    return counts * np.log(np.where(counts > 0, counts, 1))
+
+
+# The log evidence and log likelihood of a fixed partition for every window of sample_size
+# consecutive trials (the same windows as the logE progression loop in models.py).
+# Each step only removes the data points of the trial leaving the window and adds those
+# of the trial entering it, instead of rebuilding the whole window.
+def sliding_window_evidence(trialData, sample_size, MCM_partition, n, startBin, stopBin):
+    trial_states = [pack_states(trial_arr, n) for trial_arr in trial_arrays(trialData, startBin, stopBin)]
+
+    window = StateCounts(n, MCM_partition)
+    logE_list = []
+    logL_list = []
+
+    for i in range(0, len(trial_states)-sample_size):
+        if i == 0:
+            for states in trial_states[:sample_size]:
+                window.add(states)
+        else:
+            window.remove(trial_states[i-1])
+            window.add(trial_states[i+sample_size-1])
+
+        logE_list.append(window.log_evidence())
+        logL_list.append(window.log_likelihood())
+
+    return logE_list, logL_list
+
+
+# The state words (as a tuple) of a component that only contains variable i
+def variable_words(i, n):
+    if i < 64:
+        return (1 << (min(n, 64) - 1 - i), 0)
+    return (0, 1 << (n - 1 - i))
+
+
+# Greedy search for the MCM partition with the highest log evidence that starts from a given
+# partition (e.g. the MCM_best.array of the previous window or time bin) instead of from
+# independent variables. Each step only considers local moves around the current partition:
+# merging two components, or splitting a single variable off its component. The best move is
+# made as long as it increases the log evidence (for at most max_steps steps). The data is
+# collapsed into a pattern histogram once and every component is scored only once over the
+# whole search. Returns the partition in the MCM_best.array layout (size, first word, second
+# word) with its log evidence and log likelihood.
+def warm_start_search(data, n, MCM_partition, max_steps=None):
+    states, counts = as_histogram(data, n)
+
+    # Start from the given components and put any variable that is in none of them on its own
+    components = [tuple(words) for words in partition_to_words(MCM_partition, n).tolist() if any(words)]
+    for i in range(n):
+        words = variable_words(i, n)
+        if not any((c[0] & words[0]) or (c[1] & words[1]) for c in components):
+            components.append(words)
+
+    component_logE = {}
+
+    def score(new_components):
+        missing = list({c for c in new_components if c not in component_logE})
+        if missing:
+            logE, _ = score_components(states, counts, np.array(missing, dtype=np.uint64).reshape(-1, 2))
+            component_logE.update(zip(missing, logE))
+
+    score(components)
+    steps = 0
+
+    while max_steps is None or steps < max_steps:
+        # Candidate moves as (components removed, components added)
+        moves = []
+        for a in range(len(components)):
+            for b in range(a + 1, len(components)):
+                merged = (components[a][0] | components[b][0], components[a][1] | components[b][1])
+                moves.append(((a, b), (merged,)))
+
+        for a, component in enumerate(components):
+            singles = [variable_words(i, n) for i in range(n)]
+            singles = [single for single in singles if (component[0] & single[0]) or (component[1] & single[1])]
+            if len(singles) < 2:
+                continue
+            for single in singles:
+                rest = (component[0] & ~single[0], component[1] & ~single[1])
+                moves.append(((a,), (single, rest)))
+
+        score([c for _, added in moves for c in added])
+
+        gains = [
+            sum(component_logE[c] for c in added) - sum(component_logE[components[r]] for r in removed)
+            for removed, added in moves
+        ]
+        if not gains or max(gains) <= 0:
+            break
+
+        removed, added = moves[int(np.argmax(gains))]
+        components = [c for r, c in enumerate(components) if r not in removed] + list(added)
+        steps += 1
+
+    partition = [
+        (int(component_sizes(np.array([c], dtype=np.uint64))[0]), c[0], c[1]) for c in components
+    ]
+    logE, logL = evaluate_partition((states, counts), partition, n)
+
+    return partition, logE, logL
+
+
+# A seed for the random sample of one unit of a sweep, made from the seed of the sweep and
+# the key of the unit, so that a unit draws the same sample whenever (and in whichever
+# order) it is run
+def unit_seed(seed, key):
+    return [seed, int(hashlib.sha1(repr(key).encode()).hexdigest()[:16], 16)]
+
+
+# The units of a bootstrap sweep for one time bin: one (time_bin, session, visGroup,
+# audioGroup, sample) key per sample of every stimulus combination of every session
+def bootstrap_sweep_units(trialBinData, sessionData, time_bin, sample_count):
+    units = []
+
+    for ses_ID in sessionData["session_ID"]:
+        ses_ID = np.asarray(ses_ID).item()
+        ses_trials = trialBinData[trialBinData["session_ID"] == ses_ID]
+
+        for visGroup in ses_trials.visGroupPreChange.unique():
+            for audioGroup in ses_trials.audioGroupPreChange.unique():
+                for sample in range(sample_count):
+                    units.append((time_bin, ses_ID, np.asarray(visGroup).item(), np.asarray(audioGroup).item(), sample))
+
+    return units
+
+
+# Bootstrap MCMs of concatenated trials for every time bin, session and stimulus combination,
+# as a checkpointed sweep: every fitted sample is recorded in the results store at store_path
+# as soon as it is done, and samples already in the store are skipped when the sweep is rerun.
+# The binned trials of each time bin are read from spike_dir, as in models.py.
+# Returns a dictionary of the sampled trials, partition, logE and logL of every unit.
+def run_bootstrap_sweep(spike_dir, time_bins, sessionData, spikeData, store_path,
+                        sample_count=30, min_data_size=1500, seed=0, cache_dir=None):
+    neurons_by_session = utils.group_by_session(spikeData, sessionData["session_ID"])
+    n_by_session = {
+        np.asarray(ses_ID).item(): len(ses_neurons)
+        for ses_ID, ses_neurons in zip(sessionData["session_ID"], neurons_by_session)
+    }
+
+    results = {}
+    for time_bin in time_bins:
+        trialBinData = pd.read_pickle(f"{spike_dir}/binSpikeTrials_{time_bin}ms.pkl")
+
+        # Calculate the number of concatenated trials necessary for the data size
+        sample_size = math.ceil(time_bin*(min_data_size/2000))
+        stopBin = int(2000/time_bin)-1
+
+        # The (bins x neurons) data of the trials of every stimulus combination, made when first needed
+        comb_arrs = {}
+
+        def run_unit(key):
+            _, ses_ID, visGroup, audioGroup, _ = key
+            if key[1:4] not in comb_arrs:
+                combTrials = trialBinData[
+                    (trialBinData["session_ID"] == ses_ID)
+                    & (trialBinData["visGroupPreChange"] == visGroup)
+                    & (trialBinData["audioGroupPreChange"] == audioGroup)
+                ]
+                comb_arrs[key[1:4]] = trial_arrays(combTrials, 0, stopBin)
+
+            trial_arrs = comb_arrs[key[1:4]]
+            rng = np.random.default_rng(unit_seed(seed, key))
+            sample_trials = rng.choice(len(trial_arrs), size=sample_size, replace=False)
+
+            data_arr = np.concatenate([trial_arrs[t] for t in sample_trials])
+            partition, logE, logL = fit_mcm(data_arr, n_by_session[ses_ID], cache_dir)
+
+            return {"trials": sample_trials, "partition": partition, "logE": logE, "logL": logL}
+
+        units = bootstrap_sweep_units(trialBinData, sessionData, time_bin, sample_count)
+        results.update(utils.run_sweep(units, run_unit, store_path))
+
+    return results
@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import MinCompSpin_Python.MinCompSpin as mod
 import raster_plots as rplt
+import mcm_utils
 import os
 import scipy.cluster.hierarchy as sch
 from scipy.cluster.hierarchy import fcluster
@@ -23,40 +24,11 @@ def create_input_file(trialData, startBin, stopBin, filename, path):
     # A function that takes a set of trial data and turns them into
     # a binary data file that MCMs can use
 
-    # Check if the save directory exists, and if not, create it
-    if not os.path.exists(path):
-        os.makedirs(path)
+    data_arr = mcm_utils.trials_to_array(trialData, startBin, stopBin)
 
-    # Check if the input trial data is a dataframe
-    # (i.e. contains more than one trial)
-    if isinstance(trialData, pd.DataFrame):
-        # Get the trimmed trial spikes data
-        trial_spikes, _ = rplt.trim_spikes(trialData)
-
-        data_li = []
-
-        # Turn all of the trials into a single array that can be read into the file
-        for _, trial in trial_spikes.items():
-            neuron_arr = np.array(list(trial.values()))
-            t = np.transpose(neuron_arr[:, startBin:stopBin])
-            data_li.append(np.transpose(neuron_arr[:, startBin:stopBin]))
-
-        data_t = tuple(data_li)
-        data_arr = np.concatenate(data_t)
-
-    # Otherwise, handle the trialData as a series
-    else:
-        neuron_arr = np.array(list(trialData["binSpikes"].values()))
-        data_arr = np.transpose(neuron_arr[:, startBin:stopBin])
-
-    # Create and open the file in write mode
-    with open(os.path.join(path, f"{filename}.dat"), "w") as file:
-
-        # Write the contents of the data array into the file,
-        # in the structure necessary for the MCM module
-        for row in data_arr:
-            row_string = ''.join(map(str, row))
-            file.write(row_string + '\n')
+    # Write the contents of the data array into the file,
+    # in the structure necessary for the MCM module
+    mcm_utils.write_input_file(data_arr, filename, path)
 
 
 def generate_coocurrance_matrix(MCM_partitions, n):
@@ -269,8 +241,9 @@ min_fire = 0.5
 quality = 'good'
 path_root = Path("/Users/vojtamazur/Documents/Capstone_code")
 experiment = ["ChangeDetectionConflict"]
+cache_dir = "./dataCache"
 
-trialData, sessionData, spikeData, videoData = utils.load_data(path_root, experiment)
+trialData, sessionData, spikeData, videoData = utils.load_data(path_root, experiment, cache_dir=cache_dir)
 videoData["session_ID"] = sessionData["session_ID"]
 spikeData = utils.exclude_neurons(spikeData, sessionData, min_fire, quality)
 
@@ -777,13 +750,17 @@ for time_bin in time_bins:
     # Calculate the number of concatenated trials necessary for a data size of 1000
     sample_size = math.ceil(time_bin*(min_data_size/2000))
 
+    # Split the trials and neurons by session once
+    trials_by_session = utils.group_by_session(trialBinData, sessionData["session_ID"])
+    neurons_by_session = utils.group_by_session(spikeData, sessionData["session_ID"])
+
     for index, session in sessionData.iterrows():
         # get the trials from this session
         ses_ID = session["session_ID"]
-        ses_trials = trialBinData[trialBinData["session_ID"] == ses_ID]
+        ses_trials = trials_by_session[index]
 
         # Get the number of variables
-        ses_neurons = spikeData[spikeData["session_ID"] == ses_ID]
+        ses_neurons = neurons_by_session[index]
         neuron_series = ses_neurons["cell_ID"]
         n = len(neuron_series)
 
@@ -806,10 +783,8 @@ for time_bin in time_bins:
                     sampleTrials = combTrials.iloc[i:end_index, :]
 
                     # Converting the data into a format usable by the MCM
-                    filename = f"session{ses_ID}_concat_{time_bin}ms"
-                    create_input_file(sampleTrials, 0, int(2000/time_bin)-1, filename, data_dir)
-
-                    data = mod.read_datafile(f"{data_dir}/{filename}.dat", n)
+                    data_arr = mcm_utils.trials_to_array(sampleTrials, 0, int(2000/time_bin)-1)
+                    data = mcm_utils.data_from_array(data_arr, n)
 
                     # Creating the MCM
                     MCM_best = mod.MCM_GreedySearch(data, n, False)
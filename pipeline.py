@@ -0,0 +1,360 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import pickle
+import shutil
+import warnings
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from scipy.cluster.hierarchy import fcluster
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+
+import utils
+import mcm_utils
+
+warnings.filterwarnings('ignore')
+
+# Command-line entry point for the analysis pipeline. Each stage is run with
+#
+#     python pipeline.py <stage> --config config.json
+#
+# and first runs the stages it depends on. The output of every stage is cached in the
+# pipeline directory under a hash of its parameters and of the stages it depends on,
+# so a stage is only rerun when its inputs or parameters change (or with --force).
+
+
+# Default parameters of every stage; the config file only has to contain the changed values
+DEFAULT_CONFIG = {
+    "path_root": "/Users/vojtamazur/Documents/Capstone_code",
+    "experiment": ["ChangeDetectionConflict"],
+    "cache_dir": "./dataCache",
+    "pipeline_dir": "./pipelineCache",
+    "load": {"min_fire": 0.5, "n_workers": 1},
+    "window": {},
+    "binarize": {"time_bins": [10, 20, 30]},
+    "build-inputs": {},
+    "fit-mcm": {"min_data_size": 1500, "sample_count": 30, "seed": 0, "tol": None, "min_samples": 10, "n_workers": 1, "mcm_cache_dir": None},
+    "cluster": {"distance_fraction": 0.7},
+    "compare": {},
+    "plot": {"plot_dir": "./plots"},
+}
+
+# Parameters that do not change the output of a stage, so they are left out of its hash
+RUNTIME_PARAMS = {"n_workers", "cache_dir", "mcm_cache_dir"}
+
+
+# Read the config file and fill in the default values of all missing parameters
+def read_config(config_path=None):
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    if config_path is None:
+        return config
+
+    with open(config_path) as file:
+        user_config = json.load(file)
+
+    for key, value in user_config.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+
+    return config
+
+
+########################################################################################################################################################################
+# Stages: each takes its parameters, the outputs of the stages it depends on and a
+# working directory for intermediate files, and returns its output
+
+def run_load(params, inputs, work_dir):
+    trialData, sessionData, spikeData, videoData = utils.load_data(
+        params["path_root"],
+        params["experiment"],
+        n_workers=params["n_workers"],
+        cache_dir=params["cache_dir"]
+    )
+    videoData["session_ID"] = sessionData["session_ID"]
+    spikeData = utils.filter_neurons(spikeData, sessionData, min_fire=params["min_fire"])
+
+    # Group the stimuli before the change
+    trialData['visGroupPreChange'] = trialData['visualOriPreChange'].apply(utils.assign_group_visual)
+    trialData['audioGroupPreChange'] = trialData['audioFreqPreChange'].apply(utils.assign_group_auditory)
+
+    return {"trialData": trialData, "sessionData": sessionData, "spikeData": spikeData, "videoData": videoData}
+
+
+def run_window(params, inputs, work_dir):
+    data = inputs["load"]
+
+    # Only trials with a stimulus change can be windowed around it
+    return data["trialData"][data["trialData"]["stimChange"].notna()]
+
+
+# The binarized (trials x neurons x bins) spike tensors of every session at every time bin,
+# with the (trials x bins) masks of the bins that fall within each trial. The spikes of
+# each session are binned once at the finest bin size and the other sizes are derived from that.
+def run_binarize(params, inputs, work_dir):
+    data = inputs["load"]
+    intervals = [time_bin * 1000 for time_bin in params["time_bins"]]
+    binned_sessions = utils.bin_session_spikes_multi(data["sessionData"], inputs["window"], data["spikeData"], intervals)
+
+    trialBinData = {}
+    for time_bin, interval in zip(params["time_bins"], intervals):
+        trialBinData[time_bin] = {}
+        for ses_ID, binned in binned_sessions.items():
+            counts, valid = binned[interval]
+            trialBinData[time_bin][ses_ID] = (utils.binarize_counts(counts), valid)
+
+    return trialBinData
+
+
+# The (bins x neurons) data arrays of the trials of every stimulus combination of every session,
+# with the bins before the stimulus change that fall within the trial
+def run_build_inputs(params, inputs, work_dir):
+    sessionData = inputs["load"]["sessionData"]
+    neurons_by_session = utils.group_by_session(inputs["load"]["spikeData"], sessionData["session_ID"])
+    trials_by_session = utils.group_by_session(inputs["window"], sessionData["session_ID"])
+
+    mcm_inputs = {}
+    for time_bin, binned_sessions in inputs["binarize"].items():
+        stopBin = int(2000/time_bin)-1
+
+        for ses_ID, ses_trials, ses_neurons in zip(sessionData["session_ID"], trials_by_session, neurons_by_session):
+            ses_ID = np.asarray(ses_ID).item()
+            spikes, valid = binned_sessions[ses_ID]
+
+            for visGroup in ses_trials.visGroupPreChange.unique():
+                for audioGroup in ses_trials.audioGroupPreChange.unique():
+                    combTrials = np.flatnonzero(
+                        ((ses_trials["visGroupPreChange"] == visGroup) & (ses_trials["audioGroupPreChange"] == audioGroup)).to_numpy()
+                    )
+                    if len(combTrials) == 0:
+                        continue
+
+                    key = (time_bin, ses_ID, np.asarray(visGroup).item(), np.asarray(audioGroup).item())
+                    mcm_inputs[key] = {
+                        "n": len(ses_neurons),
+                        "neuron_ids": ses_neurons["cell_ID"].to_list(),
+                        "trial_arrs": [spikes[t, :, :stopBin].T[valid[t, :stopBin]] for t in combTrials],
+                    }
+
+    return mcm_inputs
+
+
+# Bootstrap MCMs of concatenated trials of every stimulus combination (mcm_utils.adaptive_bootstrap_mcm).
+# Every fit is recorded in a results store of its combination in the working directory,
+# so an interrupted stage resumes where it stopped.
+# If tol is set, the fits of a combination stop once the change of its normalized co-occurrence
+# matrix is below tol (after at least min_samples fits), with sample_count as the maximum.
+# Combinations with fewer trials than one sample needs are skipped.
+def run_fit_mcm(params, inputs, work_dir):
+    fits = {}
+    for key, comb in inputs["build-inputs"].items():
+        sample_size = math.ceil(key[0]*(params["min_data_size"]/2000))
+        if len(comb["trial_arrs"]) < sample_size:
+            print(f"fit-mcm: skipping {key}, {len(comb['trial_arrs'])} trials is less than the sample size of {sample_size}")
+            continue
+
+        store_path = os.path.join(work_dir, "fits", "_".join(str(value) for value in key) + ".pkl")
+
+        partitions, logE_list, logL_list, superimposed_matrix, changes = mcm_utils.adaptive_bootstrap_mcm(
+            comb["trial_arrs"], sample_size, comb["n"], 0, None,
+            tol=params["tol"],
+            min_samples=params["min_samples"],
+            max_samples=params["sample_count"],
+            seed=mcm_utils.unit_seed(params["seed"], key),
+            n_workers=params["n_workers"],
+            cache_dir=params["mcm_cache_dir"],
+            store_path=store_path
+        )
+
+        fits[key] = {
+            "n": comb["n"],
+            "neuron_ids": comb["neuron_ids"],
+            "partitions": partitions,
+            "logE": logE_list,
+            "logL": logL_list,
+            "matrix": superimposed_matrix,
+            "changes": changes,
+        }
+
+    return fits
+
+
+# Hierarchical clustering of the neurons of every stimulus combination by their co-occurrence
+def run_cluster(params, inputs, work_dir):
+    clusters = {}
+    for key, fit in inputs["fit-mcm"].items():
+        if fit["n"] < 2:
+            continue
+        linkage_matrix = mcm_utils.linkage_from_cooccurrence(fit["matrix"])
+        threshold = params["distance_fraction"]*max(linkage_matrix[:, 2])
+        clusters[key] = {
+            "linkage": linkage_matrix,
+            "clusters": fcluster(linkage_matrix, threshold, criterion="distance"),
+        }
+
+    return clusters
+
+
+# Mean ARI and NMI scores between the partitions of the bootstrap samples of every stimulus combination
+def run_compare(params, inputs, work_dir):
+    rows = []
+    for key, fit in inputs["fit-mcm"].items():
+        clusterings = [mcm_utils.partition_to_clusters(partition, fit["n"]) for partition in fit["partitions"]]
+
+        ari_scores = []
+        nmi_scores = []
+        for i in range(len(clusterings)):
+            for j in range(len(clusterings)):
+                if i != j:
+                    ari_scores.append(adjusted_rand_score(clusterings[i], clusterings[j]))
+                    nmi_scores.append(normalized_mutual_info_score(clusterings[i], clusterings[j]))
+
+        time_bin, ses_ID, visGroup, audioGroup = key
+        rows.append({
+            "time_Bin": time_bin,
+            "session_ID": ses_ID,
+            "visGroup": visGroup,
+            "audioGroup": audioGroup,
+            "ARI": np.mean(ari_scores) if ari_scores else np.nan,
+            "NMI": np.mean(nmi_scores) if nmi_scores else np.nan,
+        })
+
+    return pd.DataFrame(rows)
+
+
+# Heatmaps of the co-occurrence matrices, with the neurons reordered by their clusters
+def run_plot(params, inputs, work_dir):
+    saved_files = []
+    for key, fit in inputs["fit-mcm"].items():
+        time_bin, ses_ID, visGroup, audioGroup = key
+        order = np.argsort(inputs["cluster"][key]["clusters"], kind="stable") if key in inputs["cluster"] else np.arange(fit["n"])
+
+        plot_dir = os.path.join(params["plot_dir"], f"{time_bin}ms", str(ses_ID))
+        if not os.path.exists(plot_dir):
+            os.makedirs(plot_dir)
+
+        plt.figure(figsize=(10, 8))
+        plt.imshow(fit["matrix"][np.ix_(order, order)], aspect='auto', cmap='OrRd', interpolation='nearest')
+        plt.colorbar(label='Frequency of co-occurence in the same component')
+        plt.title(f"Session {ses_ID} ({time_bin}ms time bin)\nStimuli before change: {visGroup}° and {audioGroup}Hz")
+
+        file_path = os.path.join(plot_dir, f"vis{visGroup}_audio{audioGroup}.png")
+        plt.savefig(file_path)
+        plt.close()
+        saved_files.append(file_path)
+
+    return saved_files
+
+
+# The stages with the stages they depend on and the parameters they use
+# from the top level of the config (next to their own section)
+STAGES = {
+    "load": (run_load, [], ["path_root", "experiment", "cache_dir"]),
+    "window": (run_window, ["load"], []),
+    "binarize": (run_binarize, ["load", "window"], []),
+    "build-inputs": (run_build_inputs, ["load", "window", "binarize"], []),
+    "fit-mcm": (run_fit_mcm, ["build-inputs"], []),
+    "cluster": (run_cluster, ["fit-mcm"], []),
+    "compare": (run_compare, ["fit-mcm"], []),
+    "plot": (run_plot, ["fit-mcm", "cluster"], []),
+}
+
+
+########################################################################################################################################################################
+# Running the stages
+
+# The parameters of a stage: its own section of the config and the top-level values it uses
+def stage_params(stage, config):
+    _, _, top_level = STAGES[stage]
+    params = dict(config.get(stage, {}))
+    params.update({key: config[key] for key in top_level})
+    return params
+
+
+# The size and modification time of every .mat file that the load stage reads,
+# so that the load stage is rerun when the data changes
+def source_state(config):
+    state = []
+    for ses in utils.find_sessions(config["path_root"], config["experiment"]):
+        for dtype in utils.DATA_TYPES:
+            file_stat = os.stat(os.path.join(ses, f"{dtype}.mat"))
+            state.append((os.path.join(ses, dtype), file_stat.st_size, file_stat.st_mtime_ns))
+    return state
+
+
+# The hash of a stage: of its parameters and of the hashes of the stages it depends on
+def stage_hash(stage, config, hashes=None):
+    hashes = {} if hashes is None else hashes
+    if stage in hashes:
+        return hashes[stage]
+
+    _, dependencies, _ = STAGES[stage]
+    params = {key: value for key, value in stage_params(stage, config).items() if key not in RUNTIME_PARAMS}
+    stage_key = {
+        "stage": stage,
+        "params": params,
+        "dependencies": [stage_hash(dependency, config, hashes) for dependency in dependencies],
+    }
+    if stage == "load":
+        stage_key["source"] = source_state(config)
+
+    hashes[stage] = hashlib.sha1(json.dumps(stage_key, sort_keys=True, default=str).encode()).hexdigest()
+    return hashes[stage]
+
+
+# Run a stage, after the stages it depends on, re-using the cached output of every
+# stage whose parameters and inputs did not change. Returns the output of the stage.
+def run_stage(stage, config, force=False, hashes=None, outputs=None):
+    hashes = {} if hashes is None else hashes
+    outputs = {} if outputs is None else outputs
+    if stage in outputs:
+        return outputs[stage]
+
+    run_fn, dependencies, _ = STAGES[stage]
+    stage_dir = os.path.join(config["pipeline_dir"], stage)
+    output_file = os.path.join(stage_dir, f"{stage_hash(stage, config, hashes)}.pkl")
+
+    if os.path.exists(output_file) and not force:
+        print(f"{stage}: up to date")
+        with open(output_file, 'rb') as file:
+            outputs[stage] = pickle.load(file)
+        return outputs[stage]
+
+    inputs = {dependency: run_stage(dependency, config, False, hashes, outputs) for dependency in dependencies}
+
+    print(f"{stage}: running")
+    work_dir = output_file[:-len(".pkl")]
+    os.makedirs(work_dir, exist_ok=True)
+    outputs[stage] = run_fn(stage_params(stage, config), inputs, work_dir)
+
+    # Write to a temporary file first so that a crash never leaves a half-written output
+    tmp_file = f"{output_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as file:
+        pickle.dump(outputs[stage], file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, output_file)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return outputs[stage]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a stage of the analysis pipeline and the stages it depends on")
+    subparsers = parser.add_subparsers(dest="stage", required=True)
+    for stage in STAGES:
+        stage_parser = subparsers.add_parser(stage)
+        stage_parser.add_argument("--config", help="JSON file with the parameters that differ from the defaults")
+        stage_parser.add_argument("--force", action="store_true", help="rerun the stage even if its output is cached")
+
+    args = parser.parse_args(argv)
+    run_stage(args.stage, read_config(args.config), force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,8 +15,9 @@ min_fire = 0.5
 quality = 'good'
 path_root = Path("/Users/vojtamazur/Documents/Capstone_code")
 experiment = ["ChangeDetectionConflict"]
+cache_dir = "./dataCache"
 
-trialData, sessionData, spikeData, videoData = utils.load_data(path_root, experiment)
+trialData, sessionData, spikeData, videoData = utils.load_data(path_root, experiment, cache_dir=cache_dir)
 videoData["session_ID"] = sessionData["session_ID"]
 spikeData = utils.exclude_neurons(spikeData, sessionData, min_fire, quality)
 
@@ -0,0 +1,131 @@
+import math
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import mcm_utils
+
+
+# An MCM partition in the MCM_best.array layout (size, first word, second word)
+# with one component for every group of variables
+def make_partition(groups, n):
+    partition = []
+    for group in groups:
+        bits = "".join("1" if i in group else "0" for i in range(n))
+        partition.append((len(group), int(bits[:64], 2), int(bits[64:], 2) if n > 64 else 0))
+    return partition
+
+
+# The log evidence and log likelihood of a partition computed directly from the data:
+# every component from the counts of its states and every variable that is in no
+# component as an independent fair coin
+def brute_force_scores(data, groups, n):
+    N = len(data)
+    logE = logL = -(n - sum(len(group) for group in groups)) * N * math.log(2)
+
+    for group in groups:
+        m = len(group)
+        state_counts = Counter(map(tuple, data[:, sorted(group)])).values()
+        logE += math.lgamma(2**(m-1)) - math.lgamma(N + 2**(m-1))
+        logE += sum(math.lgamma(k + 0.5) - math.lgamma(0.5) for k in state_counts)
+        logL += sum(k * math.log(k / N) for k in state_counts)
+
+    return logE, logL
+
+
+# Random 0/1 data in which every variable is correlated with the one before it
+def random_data(n, N, seed):
+    rng = np.random.default_rng(seed)
+    data = (rng.random((N, n)) < 0.2).astype(np.uint8)
+    data[:, 1:] |= data[:, :-1] & (rng.random((N, n - 1)) < 0.5).astype(np.uint8)
+    return data
+
+
+# Partitions that cover all variables, leave variables out and (for n > 64) have a
+# component with variables in both words
+def example_partitions(n):
+    groups = [list(range(i, min(i + 5, n))) for i in range(0, n, 5)]
+    partial = [[0, 2, 4], [n - 1, n - 3]]
+    spanning = [list(range(n - 10, n)), [0, 1]]
+    return [groups, partial, spanning]
+
+
+@pytest.mark.parametrize("n", [10, 64, 70])
+def test_evaluate_partitions_brute_force(n):
+    data = random_data(n, 300, seed=n)
+    partitions = example_partitions(n)
+
+    logE_list, logL_list = mcm_utils.evaluate_partitions(data, [make_partition(groups, n) for groups in partitions], n)
+
+    for groups, logE, logL in zip(partitions, logE_list, logL_list):
+        expected_logE, expected_logL = brute_force_scores(data, groups, n)
+        assert logE == pytest.approx(expected_logE, rel=1e-10, abs=1e-6)
+        assert logL == pytest.approx(expected_logL, rel=1e-10, abs=1e-6)
+
+
+@pytest.mark.parametrize("n", [10, 70])
+def test_score_components_brute_force(n):
+    data = random_data(n, 200, seed=n + 1)
+    groups = example_partitions(n)[0] + example_partitions(n)[2]
+
+    states, counts = mcm_utils.pattern_histogram(data, n)
+    words = mcm_utils.partition_to_words(make_partition(groups, n), n)
+    logE, logL = mcm_utils.score_components(states, counts, words)
+
+    for c, group in enumerate(groups):
+        expected_logE, expected_logL = brute_force_scores(data, [group], n)
+        independent = -(n - len(group)) * len(data) * math.log(2)
+        assert logE[c] == pytest.approx(expected_logE - independent, rel=1e-10, abs=1e-6)
+        assert logL[c] == pytest.approx(expected_logL - independent, rel=1e-10, abs=1e-6)
+
+
+@pytest.mark.parametrize("n", [10, 70])
+def test_evaluate_partition_histogram(n):
+    data = random_data(n, 150, seed=n + 2)
+    partition = make_partition(example_partitions(n)[1], n)
+
+    assert mcm_utils.evaluate_partition(mcm_utils.pattern_histogram(data, n), partition, n) \
+        == pytest.approx(mcm_utils.evaluate_partition(data, partition, n))
+
+
+@pytest.mark.parametrize("n", [10, 70])
+def test_state_counts_sliding_window(n):
+    trials = [random_data(n, 40, seed=100 * n + t) for t in range(8)]
+    groups = example_partitions(n)[2]
+    sample_size = 3
+
+    window = mcm_utils.StateCounts(n, np.array(make_partition(groups, n), dtype=np.uint64))
+    for i in range(len(trials) - sample_size):
+        if i == 0:
+            for trial in trials[:sample_size]:
+                window.add(mcm_utils.pack_states(trial, n))
+        else:
+            window.remove(mcm_utils.pack_states(trials[i-1], n))
+            window.add(mcm_utils.pack_states(trials[i+sample_size-1], n))
+
+        expected_logE, expected_logL = brute_force_scores(np.concatenate(trials[i:i+sample_size]), groups, n)
+        assert window.N == sample_size * 40
+        assert window.log_evidence() == pytest.approx(expected_logE, rel=1e-10, abs=1e-6)
+        assert window.log_likelihood() == pytest.approx(expected_logL, rel=1e-10, abs=1e-6)
+
+
+@pytest.mark.parametrize("n", [10, 70])
+def test_warm_start_search(n):
+    data = random_data(n, 300, seed=n + 3)
+    start = make_partition(example_partitions(n)[1], n)
+
+    partition, logE, logL = mcm_utils.warm_start_search(data, n, start)
+
+    # Every variable is in exactly one component
+    groups = []
+    for size, first_word, second_word in partition:
+        bits = format(first_word, f"0{min(n, 64)}b") + (format(second_word, f"0{n-64}b") if n > 64 else "")
+        groups.append([i for i, bit in enumerate(bits) if bit == "1"])
+        assert len(groups[-1]) == size
+    assert sorted(i for group in groups for i in group) == list(range(n))
+
+    expected_logE, expected_logL = brute_force_scores(data, groups, n)
+    assert logE == pytest.approx(expected_logE, rel=1e-10, abs=1e-6)
+    assert logL == pytest.approx(expected_logL, rel=1e-10, abs=1e-6)
+    assert logE >= mcm_utils.evaluate_partition(data, start, n)[0] - 1e-9
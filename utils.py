@@ -1,45 +1,97 @@
 import scipy.io as sio
+import scipy.sparse as ssp
 import numpy as np
 import pandas as pd
 import os
 import h5py
+import hashlib
+import pickle
 from datetime import datetime
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from collections import namedtuple
 import warnings
 
 warnings.filterwarnings('ignore')
 
 def exclude_neurons(spikeData,sessionData,min_fire,quality):
+    # Only the firing rate criterion is applied, the quality criterion stays disabled
+    # (pass quality to filter_neurons to also filter on it)
+    return filter_neurons(spikeData, sessionData, min_fire=min_fire)
+
+
+# Get the number of spikes of every neuron, from a spikeData dataframe or SpikeTrains
+def count_neuron_spikes(spikeData):
+    if isinstance(spikeData, SpikeTrains):
+        return spikeData.spike_counts()
+    return np.fromiter((len(ts) for ts in spikeData['ts']), dtype=np.int64, count=len(spikeData))
+
+
+# Calculate the firing rate (spikes per second) of all neurons at once,
+# using the duration of their sessions joined by the session ID
+def neuron_firing_rates(spikeData, sessionData):
+    session_keys = [np.asarray(ses).item() for ses in sessionData['session_ID']]
+    t_start = np.array([np.asarray(t).item() for t in sessionData['t_start']], dtype=float)
+    t_stop = np.array([np.asarray(t).item() for t in sessionData['t_stop']], dtype=float)
+
+    # Session durations in whole seconds
+    durations = pd.Series(((t_stop - t_start) / 1e6).astype(int), index=session_keys)
+
+    neuron_sessions = spikeData.session_ID if isinstance(spikeData, SpikeTrains) else spikeData['session_ID'].to_numpy()
+    neuron_durations = pd.Series(neuron_sessions).map(durations).to_numpy(dtype=float)
+
+    return count_neuron_spikes(spikeData) / neuron_durations
 
-    for session in sessionData['session_ID']:
-        current_ses = sessionData[sessionData['session_ID'] == session]
-        dur = int((current_ses['t_stop'] - current_ses['t_start']) / 1e6)
-        spikes_ses = spikeData[spikeData['session_ID'] == session]
-        n_spikes = (spikes_ses['ts'].apply(len))
-        spikes_ses['fr'] = (spikes_ses['ts'].apply(len)) / dur
-        spikes_ses = spikes_ses[spikes_ses['fr'] > min_fire]
-        #spikes_ses = spikes_ses[spikes_ses['quality'] == quality]
-        if not 'spikeData_excl' in locals():
-            spikeData_excl = spikes_ses
-        else:
-            spikeData_excl = pd.concat([spikeData_excl, spikes_ses], axis=0)
+
+# Filter the neurons on several criteria in one pass: a minimum firing rate, their
+# quality, their brain areas and their sessions. Criteria that are None are not applied.
+# Works on a spikeData dataframe (adding the 'fr' column) or on SpikeTrains.
+def filter_neurons(spikeData, sessionData, min_fire=None, quality=None, areas=None, session_IDs=None):
+    neurons = spikeData.neurons if isinstance(spikeData, SpikeTrains) else spikeData
+    firing_rates = neuron_firing_rates(spikeData, sessionData)
+
+    # Neurons from sessions that are not in sessionData have no firing rate and are excluded
+    keep = ~np.isnan(firing_rates)
+    if min_fire is not None:
+        keep &= firing_rates > min_fire
+    if quality is not None:
+        keep &= (neurons['quality'] == quality).to_numpy()
+    if areas is not None:
+        keep &= neurons['area'].isin(areas).to_numpy()
+    if session_IDs is not None:
+        keep &= neurons['session_ID'].isin(session_IDs).to_numpy()
+
+    if isinstance(spikeData, SpikeTrains):
+        return spikeData.select(keep)
+
+    spikeData_excl = spikeData[keep].copy()
+    spikeData_excl['fr'] = firing_rates[keep]
 
     return spikeData_excl
 
 
-def load_mat_file(file_path, variable_name):
+def load_mat_file(file_path, variable_name, lazy=False, fields=None):
     try:
         # Try loading with scipy.io.loadmat
-        data = sio.loadmat(file_path, squeeze_me=True)
+        data = sio.loadmat(file_path, squeeze_me=True, variable_names=[variable_name])
         if variable_name in data:
-            return data[variable_name]
+            data = data[variable_name]
+            if fields is not None:
+                # Only the selected fields are converted into dataframe columns
+                data = data[[field for field in data.dtype.names if field in fields]]
+            return data
     except NotImplementedError:
         # If scipy.io.loadmat fails, try loading with h5py
+        if lazy:
+            return load_hdf5_lazy(file_path, variable_name, fields)
+
         with h5py.File(file_path, 'r') as f:
             dGroup = f[variable_name]
             # print({key: f[variable_name][key][0] for key in f[variable_name].keys()})
 
-            data = {key: f[variable_name][key] for key in f[variable_name].keys()}
+            # Fields that were not selected are never read from the file
+            data = {key: f[variable_name][key] for key in f[variable_name].keys() if fields is None or key in fields}
             return {key: np.array(resolve_hdf5_reference(data[key][0, 0], f)) for key in data.keys()}
 
 
@@ -54,6 +106,125 @@ def resolve_hdf5_reference(reference, file):
     return reference
 
 
+# Fields that are not read into memory when loading v7.3 files lazily
+LAZY_FIELDS = {'spikeData': ['ts'], 'videoData': ['area', 'ts']}
+
+# HDF5 files opened by lazy datasets, shared between all datasets of the same file
+_open_hdf5_files = {}
+
+
+def open_hdf5_file(file_path):
+    if file_path not in _open_hdf5_files:
+        _open_hdf5_files[file_path] = h5py.File(file_path, 'r')
+    return _open_hdf5_files[file_path]
+
+
+# Close the HDF5 files opened by lazy datasets (all of them, or only the given file).
+# Lazy datasets of a closed file reopen it the next time they are read.
+def close_hdf5_files(file_path=None):
+    file_paths = list(_open_hdf5_files) if file_path is None else [file_path]
+    for path in file_paths:
+        f = _open_hdf5_files.pop(path, None)
+        if f is not None:
+            f.close()
+
+
+# A proxy for a MATLAB vector stored in an HDF5 file, which only reads the requested
+# part of the vector from the open file. MATLAB saves vectors as 1xT or Tx1 matrices,
+# the proxy always behaves as a one-dimensional array of length T.
+class LazyDataset:
+    def __init__(self, file_path, name):
+        self.file_path = file_path
+        self.name = name
+
+    @property
+    def dataset(self):
+        return open_hdf5_file(self.file_path)[self.name]
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    @property
+    def shape(self):
+        return (self.dataset.size,)
+
+    def __len__(self):
+        return self.dataset.size
+
+    def __getitem__(self, key):
+        dataset = self.dataset
+        if dataset.ndim == 1:
+            return dataset[key]
+        elif dataset.shape[0] == 1:
+            return dataset[0, key]
+        else:
+            return dataset[key, 0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    # Binary search on the sorted values in the file, reading one value per step
+    def searchsorted(self, value, side='left'):
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            mid_value = self[mid]
+            if (mid_value < value) or (side == 'right' and mid_value == value):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    # Start and end index of the values within [start, end]
+    def window_indices(self, start, end):
+        return self.searchsorted(start, 'left'), self.searchsorted(end, 'right')
+
+    # Read only the values within [start, end] of a sorted vector such as spike times
+    def window(self, start, end):
+        start_idx, end_idx = self.window_indices(start, end)
+        return self[start_idx:end_idx]
+
+    # Only the file path and dataset name are pickled, the file is reopened on first access
+    def __getstate__(self):
+        return {'file_path': self.file_path, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __repr__(self):
+        return f"LazyDataset('{self.file_path}', '{self.name}', length={len(self)})"
+
+
+# Load a v7.3 .mat file with the fields in LAZY_FIELDS replaced by LazyDataset proxies
+def load_hdf5_lazy(file_path, variable_name, fields=None):
+    f = open_hdf5_file(file_path)
+    lazy_fields = LAZY_FIELDS.get(variable_name, [])
+    data = {}
+
+    for key in f[variable_name].keys():
+        if fields is not None and key not in fields:
+            continue
+
+        reference = f[variable_name][key][0, 0]
+        if key not in lazy_fields:
+            data[key] = np.array(resolve_hdf5_reference(reference, f))
+            continue
+
+        dataset = f[reference]
+        if dataset.dtype == h5py.ref_dtype:
+            # A cell array (e.g. one spike train per neuron) becomes an array of proxies
+            cell_refs = dataset[()].ravel()
+            proxies = np.empty(len(cell_refs), dtype=object)
+            proxies[:] = [LazyDataset(file_path, f[ref].name) for ref in cell_refs]
+            data[key] = proxies
+        else:
+            data[key] = LazyDataset(file_path, dataset.name)
+
+    return data
+
+
 def convert_to_dataframe(data, dtype, file_path=None):
     if isinstance(data, dict):
         data_dict = data
@@ -67,17 +238,21 @@ def convert_to_dataframe(data, dtype, file_path=None):
         for var in data_dict:
             if isinstance(data_dict[var], np.ndarray):
                 data_dict[var] = [data_dict[var]]
+            elif isinstance(data_dict[var], LazyDataset):
+                # Store the proxy as a single object, so that pandas does not iterate over it
+                proxy_column = np.empty(1, dtype=object)
+                proxy_column[0] = data_dict[var]
+                data_dict[var] = proxy_column
 
     return pd.DataFrame(data_dict)
 
 
-def load_data(path_root, experiment):
+DATA_TYPES = ['trialData', 'sessionData', 'spikeData', 'videoData']
+
+
+# Find the folders of all sessions that contain every requested data type
+def find_sessions(path_root, experiment, data_types=DATA_TYPES):
     all_sessions = []
-    data_types = ['trialData', 'sessionData', 'spikeData', 'videoData']
-    trialData = pd.DataFrame()
-    sessionData = pd.DataFrame()
-    spikeData = pd.DataFrame()
-    videoData = pd.DataFrame()
 
     for exp in experiment:
         animals = os.listdir(os.path.join(path_root, exp))
@@ -90,27 +265,165 @@ def load_data(path_root, experiment):
                     continue
                 all_sessions.append(os.path.join(path_root, exp, anml, ses))
 
-    for ses in all_sessions:
-        for dtype in data_types:
-            file_path = os.path.join(ses, f'{dtype}.mat')
-            loaded_data = load_mat_file(file_path, dtype)
-            loaded_data_df = convert_to_dataframe(loaded_data, dtype, file_path if dtype == 'videoData' else None)
+    return all_sessions
+
+
+# Load a data type from its .mat file, re-using the pickled dataframe in the
+# cache directory if the file's path, size and modification time are unchanged
+def load_cached_dataframe(file_path, dtype, cache_dir, lazy=False, fields=None):
+    file_path = os.path.abspath(file_path)
+    file_stat = os.stat(file_path)
+    file_key = (file_path, file_stat.st_size, file_stat.st_mtime_ns)
+
+    # One cache file per .mat file and loading mode, overwritten whenever the .mat file changes
+    load_mode = (file_path, lazy, None if fields is None else sorted(fields))
+    path_hash = hashlib.sha1(repr(load_mode).encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, f'{path_hash}_{dtype}.pkl')
+
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as file:
+            cached_key, cached_df = pickle.load(file)
+        if cached_key == file_key:
+            return cached_df
+
+    loaded_data = load_mat_file(file_path, dtype, lazy, fields)
+    loaded_data_df = convert_to_dataframe(loaded_data, dtype, file_path if dtype == 'videoData' else None)
+
+    # Write to a temporary file first so that parallel workers never read a half-written cache file
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as file:
+        pickle.dump((file_key, loaded_data_df), file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+
+    return loaded_data_df
+
+
+# Load a single data type of a session folder into a dataframe
+def load_session_file(ses, dtype, cache_dir=None, lazy=False, fields=None):
+    file_path = os.path.join(ses, f'{dtype}.mat')
+    if cache_dir is not None:
+        return load_cached_dataframe(file_path, dtype, cache_dir, lazy, fields)
+
+    loaded_data = load_mat_file(file_path, dtype, lazy, fields)
+    return convert_to_dataframe(loaded_data, dtype, file_path if dtype == 'videoData' else None)
+
+
+# Read only the session ID from the session data of a session folder
+def read_session_ID(ses, cache_dir=None):
+    sessionData = load_session_file(ses, 'sessionData', cache_dir, fields=['session_ID'])
+    return np.asarray(sessionData['session_ID'].iloc[0]).item()
+
+
+# Load the requested data types of a single session folder into dataframes
+# (kept at module level so that it can be sent to worker processes).
+# Returns None if the session is not one of the requested session IDs.
+def load_session(ses, data_types=DATA_TYPES, cache_dir=None, lazy=False, session_IDs=None, columns=None,
+                 neuron_filter=None):
+    # Check the session ID first, so that the files of other sessions are never read
+    if (session_IDs is not None) and (read_session_ID(ses, cache_dir) not in session_IDs):
+        return None
+
+    session_dfs = {}
+    for dtype in data_types:
+        fields = None if columns is None else columns.get(dtype)
+        session_dfs[dtype] = load_session_file(ses, dtype, cache_dir, lazy, fields)
+
+    # Filter the neurons of the session right away, so that the excluded neurons are
+    # never concatenated (and with lazy loading, their spikes are never read)
+    if (neuron_filter is not None) and ('spikeData' in session_dfs):
+        if 'sessionData' in session_dfs:
+            sessionData = session_dfs['sessionData']
+        else:
+            sessionData = load_session_file(ses, 'sessionData', cache_dir, fields=['session_ID', 't_start', 't_stop'])
+        session_dfs['spikeData'] = filter_neurons(session_dfs['spikeData'], sessionData, **neuron_filter)
+
+    return session_dfs
+
+
+# Load the data of all sessions of the experiments. Only the data types in data_types
+# are loaded (and returned in that order), optionally only for the sessions in
+# session_IDs and only the columns given per data type in columns,
+# e.g. columns={'spikeData': ['session_ID', 'cell_ID', 'area', 'ts']}.
+# The neurons can be filtered while loading with the criteria of filter_neurons,
+# e.g. neuron_filter={'min_fire': 0.5, 'areas': ['V1']}
+def load_data(path_root, experiment, n_workers=1, cache_dir=None, lazy=False,
+              data_types=DATA_TYPES, session_IDs=None, columns=None, neuron_filter=None):
+    required_types = list(data_types) if session_IDs is None else list(set(data_types) | {'sessionData'})
+    all_sessions = find_sessions(path_root, experiment, required_types)
+    load_fn = partial(
+        load_session,
+        data_types=data_types,
+        cache_dir=cache_dir,
+        lazy=lazy,
+        session_IDs=None if session_IDs is None else set(session_IDs),
+        columns=columns,
+        neuron_filter=neuron_filter
+    )
+
+    # Load the sessions one by one, or one session per task in a process pool
+    if n_workers is not None and n_workers <= 1:
+        loaded_sessions = [load_fn(ses) for ses in all_sessions]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            loaded_sessions = list(executor.map(load_fn, all_sessions))
+
+    loaded_sessions = [session_dfs for session_dfs in loaded_sessions if session_dfs is not None]
+
+    # Concatenate the session dataframes of each data type only once, in session order
+    # (starting from an empty dataframe so that no sessions still gives a dataframe)
+    data_dfs = []
+    for dtype in data_types:
+        dtype_dfs = [pd.DataFrame()] + [session_dfs[dtype] for session_dfs in loaded_sessions]
+        data_df = pd.concat(dtype_dfs, axis=0)
+        data_df.reset_index(inplace=True, drop=True)
+        data_dfs.append(data_df)
+
+    return tuple(data_dfs)
+
+
+# The data of a single session, as yielded by iter_sessions
+SessionBundle = namedtuple('SessionBundle', ['session_ID', 'sessionData', 'trialData', 'spikeData', 'videoData'])
+
+
+# Load the sessions one at a time instead of all at once,
+# so that only the data of one session is kept in memory.
+# Data types that are not requested are None in the yielded bundles.
+def iter_sessions(path_root, experiment, cache_dir=None, lazy=False,
+                  data_types=DATA_TYPES, session_IDs=None, columns=None, neuron_filter=None):
+    required_types = list(set(data_types) | {'sessionData'})
+
+    for ses in find_sessions(path_root, experiment, required_types):
+        session_ID = read_session_ID(ses, cache_dir)
+        if (session_IDs is not None) and (session_ID not in session_IDs):
+            continue
 
-            if dtype == 'trialData':
-                trialData = pd.concat([trialData, loaded_data_df], axis=0)
-            elif dtype == 'sessionData':
-                sessionData = pd.concat([sessionData, loaded_data_df], axis=0)
-            elif dtype == 'spikeData':
-                spikeData = pd.concat([spikeData, loaded_data_df], axis=0)
-            elif dtype == 'videoData':
-                videoData = pd.concat([videoData, loaded_data_df], axis=0)
+        session_dfs = load_session(ses, data_types, cache_dir, lazy, columns=columns, neuron_filter=neuron_filter)
 
-    trialData.reset_index(inplace=True, drop=True)
-    sessionData.reset_index(inplace=True, drop=True)
-    spikeData.reset_index(inplace=True, drop=True)
-    videoData.reset_index(inplace=True, drop=True)
+        # The video data does not contain the session ID, so add it here
+        if 'videoData' in session_dfs:
+            session_dfs['videoData']['session_ID'] = session_ID
 
-    return trialData, sessionData, spikeData, videoData
+        yield SessionBundle(
+            session_ID,
+            session_dfs.get('sessionData'),
+            session_dfs.get('trialData'),
+            session_dfs.get('spikeData'),
+            session_dfs.get('videoData')
+        )
+
+
+# Split a dataframe into the rows of each session with a single groupby,
+# instead of masking the whole dataframe again for every session.
+# Returns a list with the rows of each session in session_IDs, in the same order.
+def group_by_session(df, session_IDs):
+    groups = {ses: ses_df for ses, ses_df in df.groupby('session_ID', sort=False)}
+
+    # The session IDs in sessionData are loaded as 0-d arrays, which cannot be used as keys
+    session_keys = [ses.item() if isinstance(ses, np.ndarray) else ses for ses in session_IDs]
+
+    return [groups.get(ses, df.iloc[0:0]) for ses in session_keys]
 
 
 # Function to assign group number based on visual orientation angle
@@ -175,48 +488,145 @@ def get_trial_counts(trialData):
     return groupDF, beforeGroupDF, afterGroupDF
 
 
-# A function to extract only the neuron spikes in the duration of each trial
-def get_trial_spikes(sessionDF, trialDF, spikeDF):
+# Find the spikes of every neuron within many time windows [start, end] at once.
+# The spike train of each neuron is sorted, so the offsets of all windows are found
+# with one np.searchsorted call per neuron. Returns two (neurons x windows) arrays:
+# the spikes of neuron i in window j are trains.ts[offsets[i, j]:offsets[i, j] + lengths[i, j]].
+def window_spike_offsets(trains, starts, ends):
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+
+    # Windows with a missing start or end contain no spikes
+    valid = ~(np.isnan(starts) | np.isnan(ends))
+
+    offsets = np.empty((len(trains), len(starts)), dtype=np.int64)
+    lengths = np.empty((len(trains), len(starts)), dtype=np.int64)
+
+    for i in range(len(trains)):
+        train = trains.train(i)
+        start_idx = np.searchsorted(train, starts, side='left')
+        end_idx = np.searchsorted(train, ends, side='right')
+
+        offsets[i] = trains.offsets[i] + start_idx
+        lengths[i] = np.where(valid, np.maximum(end_idx - start_idx, 0), 0)
+
+    return offsets, lengths
+
+
+# Time windows around trial events, with the offsets before and after the event in microseconds.
+# The short response policy decides what happens when a trial ends before the end of the window:
+# 'clip' ends the window at the end of the trial, 'keep' ignores the end of the trial
+# and 'drop' leaves the window of that trial empty.
+TRIAL_WINDOWS = {
+    'trial': {'event': 'stimChange', 'pre': 3000000, 'post': 1000000, 'short_response': 'clip'},
+    'binning': {'event': 'stimChange', 'pre': 2000000, 'post': 1000000, 'short_response': 'clip'},
+    'pupil': {'event': 'stimChange', 'pre': 2000000, 'post': 0, 'short_response': 'keep'},
+}
+
+
+# Get the start and end time of a window in every trial, and whether
+# the trial ended before the end of the window (a short response)
+def trial_window_bounds(trialDF, window):
+    event_time = trialDF[window['event']].to_numpy(dtype=float)
+    trial_end = trialDF['trialEnd'].to_numpy(dtype=float)
+    start = event_time - window['pre']
+    end = event_time + window['post']
+
+    short_responses = ~(end <= trial_end)
+
+    if window['short_response'] == 'clip':
+        end = np.where(short_responses, trial_end, end)
+    elif window['short_response'] == 'drop':
+        start = np.where(short_responses, np.nan, start)
+        end = np.where(short_responses, np.nan, end)
+    elif window['short_response'] != 'keep':
+        raise ValueError(f"Unknown short response policy: {window['short_response']}")
+
+    return start, end, short_responses
+
+
+# Extract the spikes of every neuron in several named windows of each trial
+# (see TRIAL_WINDOWS), searching the spike train of each neuron only once for all
+# windows of all trials. For every window name, the returned trial dataframe gets a
+# '{name}Spikes' column with a dictionary of spikes per neuron and a '{name}Short' column.
+def extract_trial_windows(sessionDF, trialDF, spikeDF, windows=TRIAL_WINDOWS):
+    trains = spikeDF if isinstance(spikeDF, SpikeTrains) or has_lazy_spikes(spikeDF) else spikes_to_trains(spikeDF)
+
     newTrialDF = pd.DataFrame(columns=trialDF.columns)
-    newTrialDF["neuronSpikes"] = ''
-    newTrialDF["shortResponse"] = ''
+    for name in windows:
+        newTrialDF[f"{name}Spikes"] = ''
+        newTrialDF[f"{name}Short"] = ''
 
     for session in sessionDF["session_ID"]:
-        trialDF_ses = trialDF[trialDF["session_ID"] == session]
-        spikeDF_ses = spikeDF[spikeDF["session_ID"] == session]
-        trialSpikeData = []
-        shortResponses = []
-
-        for i, trial in trialDF_ses.iterrows():
-            trial_start = trial["stimChange"] - 3000000
-            trial_end_ts = trial["trialEnd"]
-            trial_end_stim_ch = trial["stimChange"] + 1000000
-            if trial_end_stim_ch <= trial_end_ts:
-                trial_end = trial_end_stim_ch
-                short_response = False
-            else:
-                trial_end = trial_end_ts
-                short_response = True
+        trialDF_ses = trialDF[trialDF["session_ID"] == session].copy()
+        n_trials = len(trialDF_ses)
+
+        # Put the windows of all names after each other, so that they are found in one pass
+        bounds = [trial_window_bounds(trialDF_ses, window) for window in windows.values()]
+        starts = np.concatenate([start for start, _, _ in bounds])
+        ends = np.concatenate([end for _, end, _ in bounds])
 
-            neuronSpikes = {}
+        ses_trains = session_trains(trains, session, starts, ends)
+        cell_IDs = ses_trains.cell_ID
+        offsets, lengths = window_spike_offsets(ses_trains, starts, ends)
+        window_ends = offsets + lengths
 
-            for j, neuron in spikeDF_ses.iterrows():
-                ts = neuron["ts"]
-                spikes_in_trial = ts[(ts >= trial_start) & (ts <= trial_end)]
-                neuronSpikes[neuron["cell_ID"]] = spikes_in_trial
+        for w, name in enumerate(windows):
+            trialSpikeData = []
+            for j in range(w * n_trials, (w + 1) * n_trials):
+                neuronSpikes = {cell_ID: ses_trains.ts[offsets[i, j]:window_ends[i, j]] for i, cell_ID in enumerate(cell_IDs)}
+                trialSpikeData.append(neuronSpikes)
 
-            print(len(neuronSpikes))
-            trialID = trial["trialNum"]
-            trialSpikeData.append(neuronSpikes)
-            shortResponses.append(short_response)
+            trialDF_ses[f"{name}Spikes"] = trialSpikeData
+            trialDF_ses[f"{name}Short"] = list(bounds[w][2])
 
-        trialDF_ses["neuronSpikes"] = trialSpikeData
-        trialDF_ses["shortResponse"] = shortResponses
         newTrialDF = pd.concat([newTrialDF, trialDF_ses], axis=0)
 
     return newTrialDF
 
 
+# A function to extract only the neuron spikes in the duration of each trial
+# (from 3s before the stimulus change until 1s after it, or the end of the trial if it was shorter).
+# spikeDF can be the spikeData dataframe or SpikeTrains; the spikes of each neuron in a trial
+# are views into the SpikeTrains timestamp buffer rather than copies.
+def get_trial_spikes(sessionDF, trialDF, spikeDF):
+    newTrialDF = extract_trial_windows(sessionDF, trialDF, spikeDF, {'trial': TRIAL_WINDOWS['trial']})
+    return newTrialDF.rename(columns={"trialSpikes": "neuronSpikes", "trialShort": "shortResponse"})
+
+
+# Extract a video variable (e.g. the pupil area) in a window of every trial,
+# by default the 2s before the stimulus change. The video data can also be loaded lazily.
+def get_trial_video(sessionDF, trialDF, videoDF, window=TRIAL_WINDOWS['pupil'], column='area'):
+    trial_values = pd.Series(index=trialDF.index, dtype=object)
+
+    for session in sessionDF["session_ID"]:
+        trialDF_ses = trialDF[trialDF["session_ID"] == session]
+        videoDF_ses = videoDF[videoDF["session_ID"] == session]
+        video_ts = videoDF_ses["ts"].iloc[0]
+        video_values = videoDF_ses[column].iloc[0]
+
+        # Eagerly loaded video vectors are saved as 1xT matrices
+        if isinstance(video_ts, np.ndarray) and video_ts.ndim == 2:
+            video_ts, video_values = video_ts[0], video_values[0]
+
+        # Lazily loaded frame times are read once and searched in memory
+        if isinstance(video_ts, LazyDataset):
+            video_ts = np.atleast_1d(video_ts[:]).ravel()
+
+        # The video frames in [start, end) of each trial
+        starts, ends, _ = trial_window_bounds(trialDF_ses, window)
+        start_idx = np.searchsorted(video_ts, starts, side='left')
+        end_idx = np.searchsorted(video_ts, ends, side='left')
+
+        for idx, start, end, i0, i1 in zip(trialDF_ses.index, starts, ends, start_idx, end_idx):
+            if np.isnan(start) or np.isnan(end):
+                trial_values.at[idx] = []
+            else:
+                trial_values.at[idx] = list(video_values[i0:i1])
+
+    return trial_values
+
+
 def save_df_to_pickle(df, name, path):
     # Get the current date and time
     current_time = datetime.now()
@@ -238,7 +648,6 @@ def save_df_to_pickle(df, name, path):
 
 def binarize_neurons_in_trial(trialData, interval):
     trialSpikeData = []
-    print("Starting binarization of neuron firing spikes")
 
     # Iterate through each trial and get its start and end time
     # (or 1s after stim. change if the trial was longer)
@@ -254,7 +663,6 @@ def binarize_neurons_in_trial(trialData, interval):
 
         # Initialize the array of time bins
         intervals = np.arange(start_time, end_time, interval)
-        print(end_time - start_time)
 
         for neuron, firing_timestamps in trial["neuronSpikes"].items():
             # Convert firing_timestamps to a NumPy array for efficient processing
@@ -262,7 +670,6 @@ def binarize_neurons_in_trial(trialData, interval):
 
             # Use np.digitize to find the interval each timestamp falls into
             bins = np.digitize(ts_array, intervals)
-            print(bins)
 
             # Initialize bin_series with 0 (indicating no firing)
             bin_series = np.full(len(intervals), 0)
@@ -273,52 +680,516 @@ def binarize_neurons_in_trial(trialData, interval):
             bin_neuron_spikes[neuron] = bin_series
 
         trialSpikeData.append(bin_neuron_spikes)
-        print(f"Trial {trial['trialNum']} done")
-        print(len(trial["neuronSpikes"]))
 
     trialData["binSpikes"] = trialSpikeData
     return trialData
 
-def count_bin_spikes(trialData, interval):
+# Count the spikes of every neuron in the time bins of every trial (from 2s before the stimulus
+# change until 1s after it, or the end of the trial if it was shorter), from the neuronSpikes
+# of get_trial_spikes. The spikes are binned by window_spike_bins, so only the spikes within
+# this window are counted. Returns a list with a dictionary of spike counts per neuron for
+# every trial, or with sparse=True a CSR matrix with one row per trial and neuron (in the order
+# of trialData and its neuronSpikes dictionaries) and one column per time bin, together with
+# the (trial index, neuron) of every row.
+def count_bin_spikes(trialData, interval, sparse=False):
+    spike_rows, spike_bins, n_bins, row_lengths, row_keys = trial_spike_bins(trialData, interval)
+
+    if sparse:
+        counts = spike_count_matrix(spike_rows, spike_bins, len(row_keys), n_bins)
+        return counts, pd.MultiIndex.from_tuples(row_keys, names=["trial", "neuron"])
+
+    counts = np.bincount(spike_rows * n_bins + spike_bins, minlength=len(row_keys) * n_bins)
+    counts = counts.reshape(len(row_keys), n_bins)
+
+    # Split the rows into a dictionary per trial, with the bins that fall within the trial
     trialSpikeCounts = []
+    row = 0
+    for trial_neurons in trialData["neuronSpikes"]:
+        bin_spike_counts = {}
+        for neuron in trial_neurons:
+            bin_spike_counts[neuron] = counts[row, :row_lengths[row]]
+            row += 1
+        trialSpikeCounts.append(bin_spike_counts)
 
-    # Iterate through each trial and get its start and end time
-    # (or 1s after stim. change if the trial was longer)
-    for index, trial in trialData.iterrows():
-        start_time  = trial["stimChange"] - 2000000
-        if trial["shortResponse"]:
-            end_time = trial["trialEnd"]
+    return trialSpikeCounts
+
+
+# Find the time bin of every spike in the neuronSpikes of every trial of trialData, with the
+# bins of window_spike_bins (only the spikes within the window are kept). Returns the row of
+# each spike (one row per trial and neuron, in the order of trialData and its neuronSpikes
+# dictionaries) and its bin, the number of bins of the full window, the number of bins of
+# every row that fall within its trial and the (trial index, neuron) of every row.
+def trial_spike_bins(trialData, interval, window=TRIAL_WINDOWS['binning']):
+    starts, ends, _ = trial_window_bounds(trialData, window)
+    n_bins = int(np.ceil((window['pre'] + window['post']) / interval))
+
+    # Number of bins that fall within each trial
+    window_lengths = np.nan_to_num(ends - starts, nan=0.0)
+    n_valid = np.minimum(np.ceil(window_lengths / interval), n_bins).astype(np.int64)
+
+    spike_rows = [np.zeros(0, dtype=np.int64)]
+    spike_bins = [np.zeros(0, dtype=np.int64)]
+    row_lengths = []
+    row_keys = []
+
+    for t, (index, trial_neurons) in enumerate(trialData["neuronSpikes"].items()):
+        # Put the spikes of all neurons of the trial together
+        neuron_spikes = [np.atleast_1d(np.asarray(ts, dtype=float)).ravel() for ts in trial_neurons.values()]
+        ts_array = np.concatenate(neuron_spikes) if neuron_spikes else np.zeros(0)
+        rows = np.repeat(np.arange(len(neuron_spikes)) + len(row_keys), [len(ts) for ts in neuron_spikes])
+
+        # A spike exactly at the end of the window belongs to the last bin
+        in_window = (ts_array >= starts[t]) & (ts_array <= ends[t])
+        bins = ((ts_array[in_window] - starts[t]) // interval).astype(np.int64)
+        spike_rows.append(rows[in_window])
+        spike_bins.append(np.minimum(bins, n_valid[t] - 1))
+
+        row_lengths.extend([n_valid[t]] * len(neuron_spikes))
+        row_keys.extend((index, neuron) for neuron in trial_neurons)
+
+    return np.concatenate(spike_rows), np.concatenate(spike_bins), n_bins, np.array(row_lengths, dtype=np.int64), row_keys
+
+
+# The mean of the non-zero spike counts of every row (trial and neuron) of a sparse count
+# matrix, averaged over the rows with at least one spike, computed on the stored entries only
+def mean_nonzero_count(counts):
+    counts = ssp.csr_matrix(counts)
+    counts.sum_duplicates()
+    counts.eliminate_zeros()
+
+    nonzero_bins = np.diff(counts.indptr)
+    row_sums = np.asarray(counts.sum(axis=1)).ravel()
+    spiking_rows = nonzero_bins > 0
+
+    return np.mean(row_sums[spiking_rows] / nonzero_bins[spiking_rows])
+
+
+
+# A compact container for the spike trains of many neurons. All timestamps are stored
+# in one contiguous buffer (in their original type, so no timestamp is changed) and
+# the spikes of neuron i are ts[offsets[i]:offsets[i+1]].
+# The remaining spikeData columns (cell_ID, area, session_ID, ...) are kept in the
+# parallel 'neurons' dataframe, one row per neuron.
+class SpikeTrains:
+    def __init__(self, ts, offsets, neurons, ts_dtype=np.float64, ts_position=None):
+        self.ts = ts
+        self.offsets = offsets
+        self.neurons = neurons
+        self.ts_dtype = ts_dtype
+        self.ts_position = ts_position
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def cell_ID(self):
+        return self.neurons["cell_ID"].to_numpy()
+
+    @property
+    def area(self):
+        return self.neurons["area"].to_numpy()
+
+    @property
+    def session_ID(self):
+        return self.neurons["session_ID"].to_numpy()
+
+    # Number of spikes of every neuron
+    def spike_counts(self):
+        return np.diff(self.offsets)
+
+    # Index of the neuron that fired each spike in the buffer
+    def spike_neurons(self):
+        return np.repeat(np.arange(len(self)), self.spike_counts())
+
+    # The spike train of a single neuron (a view into the buffer, not a copy)
+    def train(self, i):
+        return self.ts[self.offsets[i]:self.offsets[i + 1]]
+
+    # Get a new container with only the neurons selected by a boolean mask or index array
+    def select(self, selection):
+        idx = np.arange(len(self))[selection]
+        counts = self.spike_counts()[idx]
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+        # Gather the selected trains with one fancy index into the buffer
+        buffer_idx = np.repeat(self.offsets[idx] - offsets[:-1], counts) + np.arange(offsets[-1])
+
+        return SpikeTrains(self.ts[buffer_idx], offsets, self.neurons.iloc[idx], self.ts_dtype, self.ts_position)
+
+    def session(self, session_ID):
+        return self.select(self.session_ID == session_ID)
+
+
+# Convert the spikeData dataframe into the SpikeTrains container
+def spikes_to_trains(spikeDF):
+    trains = [np.atleast_1d(np.asarray(ts)).ravel() for ts in spikeDF["ts"]]
+    counts = np.array([len(ts) for ts in trains], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    # Keep the timestamps in their original type, so that fractional timestamps
+    # are not changed and the conversion back is exact
+    ts_dtype = np.result_type(*trains) if trains else np.float64
+    if trains:
+        ts = np.concatenate(trains).astype(ts_dtype, copy=False)
+    else:
+        ts = np.zeros(0, dtype=ts_dtype)
+
+    # Make sure the spikes of every neuron are sorted in time
+    neuron_idx = np.repeat(np.arange(len(trains)), counts)
+    if np.any((np.diff(ts) < 0) & (np.diff(neuron_idx) == 0)):
+        ts = ts[np.lexsort((ts, neuron_idx))]
+
+    neurons = spikeDF.drop(columns="ts")
+    ts_position = spikeDF.columns.get_loc("ts")
+
+    return SpikeTrains(ts, offsets, neurons, ts_dtype, ts_position)
+
+
+# Whether the spike trains of a spikeData dataframe are LazyDataset proxies (loaded with lazy=True)
+def has_lazy_spikes(spikeDF):
+    return isinstance(spikeDF, pd.DataFrame) and len(spikeDF) > 0 and isinstance(spikeDF["ts"].iloc[0], LazyDataset)
+
+
+# Merge time windows [start, end] that overlap, dropping windows with a missing start or end
+def merge_windows(starts, ends):
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+    valid = ~(np.isnan(starts) | np.isnan(ends))
+    order = np.argsort(starts[valid], kind='stable')
+
+    merged = []
+    for start, end in zip(starts[valid][order], ends[valid][order]):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
         else:
-            end_time = trial["stimChange"] + 1000000
+            merged.append([start, end])
 
-        # Initialize the bin spikes dictionary
-        bin_spike_counts = {}
+    return merged
 
-        # Initialize the array of time bins
-        intervals = np.arange(start_time, end_time, interval)
 
-        for neuron, firing_timestamps in trial["neuronSpikes"].items():
-            # Convert firing_timestamps to a NumPy array for efficient processing
-            ts_array = np.array(firing_timestamps)
+# Keep only the spikes within the given time windows from lazily loaded spike trains,
+# as a SpikeTrains container with just these spikes. The trains are read one neuron at
+# a time and all windows are found with one np.searchsorted call per neuron (a binary
+# search in the file reads one value per step, which is far slower), so at most one full
+# train is in memory. Overlapping windows are merged first so no spike is kept twice.
+def lazy_window_trains(spikeDF, starts, ends):
+    windows = np.array(merge_windows(starts, ends), dtype=float).reshape(-1, 2)
 
-            # Use np.digitize to find the interval each timestamp falls into
-            bins = np.digitize(ts_array, intervals)
+    window_ts = []
+    for proxy in spikeDF["ts"]:
+        train = np.atleast_1d(proxy[:]).ravel()
+        start_idx = np.searchsorted(train, windows[:, 0], side='left')
+        end_idx = np.searchsorted(train, windows[:, 1], side='right')
+        pieces = [train[:0]] + [train[i0:i1] for i0, i1 in zip(start_idx, end_idx)]
+        window_ts.append(np.concatenate(pieces))
 
-            # Initialize count_series with 0
-            count_series = np.full(len(intervals), 0)
+    windowDF = spikeDF.copy()
+    windowDF["ts"] = pd.Series(window_ts, index=spikeDF.index, dtype=object)
 
-            # Count the number of spikes in a time bin and add it to the count_series
-            for spike in bins:
-                count_series[spike-1] += 1
+    return spikes_to_trains(windowDF)
 
-            bin_spike_counts[neuron] = count_series
 
-        trialSpikeCounts.append(bin_spike_counts)
-        # print(f"Trial {trial['trialNum']} done")
+# The spike trains of one session. For lazily loaded spikeData only the spikes
+# within the given windows are read, otherwise all spikes of the session are kept.
+def session_trains(trains, session_ID, starts, ends):
+    if isinstance(trains, SpikeTrains):
+        return trains.session(session_ID)
 
-    # trialData[f"binSpikeCounts{int(interval/1000)}"] = trialSpikeCounts
-    return trialSpikeCounts
+    spikeDF_ses = trains[trains["session_ID"].to_numpy() == session_ID]
+    if has_lazy_spikes(spikeDF_ses):
+        return lazy_window_trains(spikeDF_ses, starts, ends)
+    return spikes_to_trains(spikeDF_ses)
+
+
+# Convert the SpikeTrains container back into the spikeData dataframe format
+def trains_to_spikes(trains):
+    spikeDF = trains.neurons.copy()
+    ts_list = [trains.train(i).astype(trains.ts_dtype) for i in range(len(trains))]
+
+    # Put the 'ts' column back in its original place
+    ts_position = len(spikeDF.columns) if trains.ts_position is None else trains.ts_position
+    spikeDF.insert(ts_position, "ts", pd.Series(ts_list, index=spikeDF.index, dtype=object))
+
+    return spikeDF
+
+
+# Find the time bin of every spike of every neuron in the window of every trial of one session.
+# Returns the row (trial * neurons + neuron) and the bin of each spike, the number of bins of
+# the full window and the (trials x bins) mask of the bins that fall within each trial.
+def window_spike_bins(trains, trialDF, interval, window=TRIAL_WINDOWS['binning']):
+    starts, ends, _ = trial_window_bounds(trialDF, window)
+    n_trials, n_neurons = len(trialDF), len(trains)
+    n_bins = int(np.ceil((window['pre'] + window['post']) / interval))
+
+    # Number of bins that fall within each trial
+    window_lengths = np.nan_to_num(ends - starts, nan=0.0)
+    n_valid = np.minimum(np.ceil(window_lengths / interval), n_bins).astype(np.int64)
+    valid = np.arange(n_bins)[None, :] < n_valid[:, None]
+
+    # Find the spikes of all neurons in all trials, ordered by trial and then neuron
+    offsets, lengths = window_spike_offsets(trains, starts, ends)
+    offsets, lengths = offsets.T.ravel(), lengths.T.ravel()
+    spike_rows = np.repeat(np.arange(n_trials * n_neurons), lengths)
+    first_spikes = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    spike_idx = np.repeat(offsets - first_spikes, lengths) + np.arange(lengths.sum())
+
+    # Time bin of every spike; a spike exactly at the end of the window belongs to the last bin
+    spike_trials = spike_rows // max(n_neurons, 1)
+    spike_bins = ((trains.ts[spike_idx] - starts[spike_trials]) // interval).astype(np.int64)
+    spike_bins = np.minimum(spike_bins, n_valid[spike_trials] - 1)
+
+    return spike_rows, spike_bins, n_bins, valid
+
+
+# Count the spikes of every neuron in the time bins of every trial of one session, as a single
+# (trials x neurons x bins) tensor. The bins start at the start of the window and every trial
+# gets the number of bins of the full window; bins after the end of a shorter trial stay empty
+# and are marked as False in the returned (trials x bins) validity mask. The counts of all spikes
+# are made with one np.bincount call, in uint8 (or uint16 if a bin has more than 255 spikes).
+def bin_trial_spikes(trains, trialDF, interval, window=TRIAL_WINDOWS['binning']):
+    spike_rows, spike_bins, n_bins, valid = window_spike_bins(trains, trialDF, interval, window)
+    n_trials, n_neurons = len(trialDF), len(trains)
+
+    counts = np.bincount(spike_rows * n_bins + spike_bins, minlength=n_trials * n_neurons * n_bins)
+
+    return compact_counts(counts).reshape(n_trials, n_neurons, n_bins), valid
+
+
+# Sparse version of bin_trial_spikes: a CSR matrix with one row per trial and neuron
+# (row trial * neurons + neuron) and one column per time bin, so that the memory
+# scales with the number of spikes instead of the number of bins
+def sparse_trial_spike_counts(trains, trialDF, interval, window=TRIAL_WINDOWS['binning']):
+    spike_rows, spike_bins, n_bins, valid = window_spike_bins(trains, trialDF, interval, window)
+
+    return spike_count_matrix(spike_rows, spike_bins, len(trialDF) * len(trains), n_bins), valid
+
+
+# Count the spikes of every row and bin into a (rows x bins) CSR matrix
+def spike_count_matrix(spike_rows, spike_bins, n_rows, n_bins):
+    counts = ssp.csr_matrix(
+        (np.ones(len(spike_rows), dtype=np.int32), (spike_rows, spike_bins)),
+        shape=(n_rows, n_bins)
+    )
+    counts.sum_duplicates()
+
+    return counts
+
+
+# Store spike counts as uint8, or as uint16 if a bin has more than 255 spikes
+def compact_counts(counts):
+    count_dtype = np.uint8 if counts.max(initial=0) <= np.iinfo(np.uint8).max else np.uint16
+    return counts.astype(count_dtype)
+
+
+# A binarized view of a count tensor: 1 if a neuron fired at least once in a time bin
+def binarize_counts(counts):
+    return (counts > 0).view(np.uint8)
+
+
+# Bin the spikes of the trials of every session, see bin_trial_spikes.
+# Returns a dictionary with the (counts, valid) tensors of each session ID.
+def bin_session_spikes(sessionDF, trialDF, spikeDF, interval, window=TRIAL_WINDOWS['binning']):
+    binned_sessions = bin_session_spikes_multi(sessionDF, trialDF, spikeDF, [interval], window)
+    return {session: binned[interval] for session, binned in binned_sessions.items()}
+
+
+# Bin the spikes of the trials of every session at several bin sizes, with a single binning
+# pass per session (see bin_trial_spikes_multi). Returns a dictionary with, for each
+# session ID, a dictionary with the (counts, valid) tensors of every interval.
+def bin_session_spikes_multi(sessionDF, trialDF, spikeDF, intervals, window=TRIAL_WINDOWS['binning']):
+    trains = spikeDF if isinstance(spikeDF, SpikeTrains) or has_lazy_spikes(spikeDF) else spikes_to_trains(spikeDF)
+    binned_sessions = {}
+
+    for session in sessionDF["session_ID"]:
+        trialDF_ses = trialDF[trialDF["session_ID"] == session]
+        starts, ends, _ = trial_window_bounds(trialDF_ses, window)
+        ses_trains = session_trains(trains, session, starts, ends)
+        binned_sessions[np.asarray(session).item()] = bin_trial_spikes_multi(ses_trains, trialDF_ses, intervals, window)
+
+    return binned_sessions
+
+
+# Turn a (trials x neurons x bins) tensor into one with bins that are 'factor' times longer,
+# by summing the counts of each group of neighbouring bins (or by taking their logical OR
+# if the tensor is binarized). A longer bin is valid if any of its shorter bins is valid.
+def coarsen_bins(counts, valid, factor, binary=False):
+    n_trials, n_neurons, n_bins = counts.shape
+    n_coarse_bins = -(-n_bins // factor)
+    padding = n_coarse_bins * factor - n_bins
+
+    grouped = np.pad(counts, ((0, 0), (0, 0), (0, padding))).reshape(n_trials, n_neurons, n_coarse_bins, factor)
+    if binary:
+        coarse_counts = grouped.max(axis=3)
+    else:
+        coarse_counts = compact_counts(grouped.sum(axis=3, dtype=np.uint32))
+
+    coarse_valid = np.pad(valid, ((0, 0), (0, padding))).reshape(n_trials, n_coarse_bins, factor).any(axis=2)
+
+    return coarse_counts, coarse_valid
+
+
+# Bin the spikes of one session at several bin sizes with a single binning pass.
+# The spikes are binned once at the largest bin size that divides all requested
+# sizes, and the other sizes are derived from that with coarsen_bins.
+# Returns a dictionary with the (counts, valid) tensors of every interval.
+def bin_trial_spikes_multi(trains, trialDF, intervals, window=TRIAL_WINDOWS['binning']):
+    base_interval = int(np.gcd.reduce([int(interval) for interval in intervals]))
+    base_counts, base_valid = bin_trial_spikes(trains, trialDF, base_interval, window)
+
+    return derive_intervals(base_counts, base_valid, base_interval, intervals)
+
+
+# Derive the tensors of every interval (a multiple of base_interval) from the finest binning
+def derive_intervals(base_counts, base_valid, base_interval, intervals, binary=False):
+    binned = {}
+
+    for interval in intervals:
+        factor, remainder = divmod(int(interval), base_interval)
+        if remainder != 0:
+            raise ValueError(f"Interval {interval} is not a multiple of the base interval {base_interval}")
+        if factor == 1:
+            binned[interval] = (base_counts, base_valid)
+        else:
+            binned[interval] = coarsen_bins(base_counts, base_valid, factor, binary)
+
+    return binned
+
+
+# Save the finest binning of a session as a single file, from which all coarser
+# intervals can be derived again when it is loaded
+def save_binned_spikes(path, counts, valid, interval):
+    path = Path(path)
+    if not os.path.exists(path.parent):
+        os.makedirs(path.parent)
+    np.savez_compressed(path, counts=counts, valid=valid, interval=interval)
+
+
+def load_binned_spikes(path, intervals=None):
+    with np.load(path) as binned_file:
+        counts, valid = binned_file['counts'], binned_file['valid']
+        base_interval = int(binned_file['interval'])
+
+    if intervals is None:
+        intervals = [base_interval]
+
+    return derive_intervals(counts, valid, base_interval, intervals)
+
+
+# Number of set bits in every possible byte, for counting bits in packed data
+POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+# Pack a binarized (trials x neurons x bins) tensor into bits along the neuron axis,
+# storing 8 neurons per byte. Returns a (trials x ceil(neurons/8) x bins) uint8 array.
+def pack_spikes(binary):
+    return np.packbits(np.asarray(binary, dtype=bool), axis=1)
+
+
+def unpack_spikes(packed, n_neurons):
+    return np.unpackbits(packed, axis=1, count=n_neurons)
+
+
+# Number of neurons that fired in every time bin of every trial, counted on the packed bytes
+def population_spike_counts(packed):
+    return POPCOUNT_TABLE[packed].sum(axis=1, dtype=np.uint32)
+
+
+# Fraction of the (valid) time bins in which each neuron fired
+def neuron_firing_frequencies(packed, n_neurons, valid=None):
+    if valid is None:
+        valid = np.ones((packed.shape[0], packed.shape[2]), dtype=bool)
+    valid_bytes = packed * valid[:, None, :].astype(np.uint8)
+
+    # Count the set bits of each bit position separately; bit 7 of byte k is neuron 8k
+    fire_counts = np.zeros(packed.shape[1] * 8, dtype=np.int64)
+    for bit in range(8):
+        fire_counts[7 - bit::8] = ((valid_bytes >> bit) & 1).sum(axis=(0, 2))
+
+    return fire_counts[:n_neurons] / valid.sum()
+
+
+# Convert the binSpikes column of the trials of one session in trialBinData
+# (a dictionary of int64 arrays per trial) into a packed tensor. Trials are padded to the longest trial; the returned validity
+# mask marks the bins that belong to each trial.
+def pack_bin_spikes(trialBinData):
+    bin_spikes = list(trialBinData["binSpikes"])
+    neuron_ids = list(bin_spikes[0].keys()) if bin_spikes else []
+    n_bins = max((len(arr) for trial in bin_spikes for arr in trial.values()), default=0)
+
+    binary = np.zeros((len(bin_spikes), len(neuron_ids), n_bins), dtype=bool)
+    valid = np.zeros((len(bin_spikes), n_bins), dtype=bool)
+    for j, trial in enumerate(bin_spikes):
+        for i, neuron in enumerate(neuron_ids):
+            arr = trial[neuron]
+            binary[j, i, :len(arr)] = arr
+            valid[j, :len(arr)] = True
+
+    return pack_spikes(binary), valid, neuron_ids
+
+
+# Convert a packed tensor back into binSpikes dictionaries, for the existing plotting code
+def unpack_bin_spikes(packed, valid, neuron_ids):
+    binary = unpack_spikes(packed, len(neuron_ids)).astype(np.int64)
+    n_valid = valid.sum(axis=1)
+
+    return [{neuron: binary[j, i, :n_valid[j]] for i, neuron in enumerate(neuron_ids)}
+            for j in range(binary.shape[0])]
+
+
+# Read the results of the completed units of a sweep from an append-only results store:
+# a file of pickled (unit key, result) records, one appended per completed unit.
+# A record that was cut off by a crash while it was written is removed from the end of
+# the file, so that new records can be appended after the last complete one.
+def load_results_store(store_path):
+    results = {}
+    if not os.path.exists(store_path):
+        return results
+
+    with open(store_path, 'rb+') as file:
+        complete_end = 0
+        while True:
+            try:
+                key, result = pickle.load(file)
+            except (EOFError, pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+                break
+            results[key] = result
+            complete_end = file.tell()
+
+        file.truncate(complete_end)
+
+    return results
+
+
+# Append the result of one completed unit of a sweep to a results store,
+# flushed to the disk right away so that it survives a crash of the sweep
+def append_result(store_path, key, result):
+    store_dir = os.path.dirname(store_path)
+    if store_dir and not os.path.exists(store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+
+    with open(store_path, 'ab') as file:
+        pickle.dump((key, result), file, protocol=pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+# Run a sweep over units (hashable keys, e.g. (time_bin, session, visGroup, audioGroup, sample)),
+# calling run_unit(key) for each unit and recording its result in the results store as soon as
+# it is done. Units that are already in the store are skipped, so an interrupted sweep resumes
+# where it stopped. With batch=True, run_unit is called once with the list of all units that are
+# not done yet and has to yield their results in that order (e.g. from a process pool); each
+# result is still recorded as soon as it is yielded. Returns the results of all units,
+# in the order of the units.
+def run_sweep(units, run_unit, store_path, batch=False):
+    completed = load_results_store(store_path)
 
+    pending = [key for key in dict.fromkeys(units) if key not in completed]
+    unit_results = run_unit(pending) if batch else map(run_unit, pending)
+    for key, result in zip(pending, unit_results):
+        completed[key] = result
+        append_result(store_path, key, result)
+
+    return {key: completed[key] for key in units}
 
 
 